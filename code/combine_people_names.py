@@ -19,9 +19,8 @@ John and Jane Smith
 Smith Family
 """
 
+import os
 import random
-import pandas as pd
-import numpy as np
 
 styles_list = (
     '{given}',
@@ -61,16 +60,34 @@ def generate_name(row):
 
 def get_input(input_fn):
     """Read and prepare the input"""
+    import pandas as pd
+    import re
     print('Reading file:', input_fn)
-    wiki = pd.read_csv(input_fn)
+    keep_cols = ['given_nameLabel', 'family_nameLabel', 'sex_or_genderLabel']
+    use_cols = keep_cols + ['country_of_citizenshipLabel']
+    if os.path.isdir(input_fn):
+        # stream each result of wikidata_person_bio.py, even from its pack files
+        from wikidata_person_bio import list_results, open_result
+        frames = []
+        for result in list_results(input_fn):
+            with open_result(result) as f:
+                frames.append(pd.read_csv(f, usecols=use_cols))
+        wiki = pd.concat(frames, ignore_index=True)
+    else:
+        wiki = pd.read_csv(input_fn, usecols=use_cols)
     print('Original row count: {:,}'.format(wiki.shape[0]))
     print('Filtering')
-    keep_cols = ['given_nameLabel', 'family_nameLabel', 'sex_or_genderLabel']
-    keep_rows_g = wiki.sex_or_genderLabel.isin(('male', 'female'))
-    keep_rows_c = wiki.country_of_citizenshipLabel.isin(
-        ('United States of America', 'Canada', 'United Kingdom'))
-    keep_rows = keep_rows_g & keep_rows_c
-    wiki = wiki[keep_rows][keep_cols]
+    # combine_wikidata_person.py joins the values of a person with a
+    # pipe, so match the country anywhere in the list.
+    countries = ('United States of America', 'Canada', 'United Kingdom')
+    country_re = r'(?:^|\|)(?:%s)(?:\||$)' % '|'.join(map(re.escape, countries))
+    keep_rows_c = wiki.country_of_citizenshipLabel.str.contains(country_re, na=False)
+    wiki = wiki[keep_rows_c][keep_cols]
+    # one row for each combination of names and gender, as in the
+    # uncombined files
+    for col in keep_cols:
+        wiki = wiki.assign(**{col: wiki[col].str.split('|')}).explode(col)
+    wiki = wiki[wiki.sex_or_genderLabel.isin(('male', 'female'))]
     wiki.dropna(inplace=True)
     new_cols = {'given_nameLabel': 'given',
                 'family_nameLabel': 'surname', 'sex_or_genderLabel': 'gender'}
@@ -80,6 +97,9 @@ def get_input(input_fn):
 
 
 def generate_names(comb):
+    import pandas as pd
+    import numpy as np
+
     def add_sample_col(choices, label):
         new_col = pd.DataFrame(choices, columns=[label]).sample(
             n=comb.shape[0], replace=True).reset_index(drop=True)
@@ -157,7 +177,8 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'input_filename', help='Wikidata .csv file as generated from this repository')
+        'input_filename', help='Wikidata .csv file as generated from this repository, '
+        'or the data directory of wikidata_person_bio.py')
     parser.add_argument('count', help='number of records to export', type=int)
     parser.add_argument('output_filename',
                         help='.csv file generated by the program')
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+#
+# Copyright (C) 2024 by Compassion International.  All rights reserved.
+# License GPLv3+: GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law.
+
+
+"""
+Combine the results downloaded by wikidata_person_bio.py, as CSV
+files or in pack files, into a single CSV file with one row per person.
+
+The OPTIONAL joins in the query return one row for each combination of
+family name, given name, citizenship, and so on. Here each column
+keeps the distinct values of a person, sorted and joined by a pipe, as
+in "Canada|United Kingdom". A person with several dates of birth may
+be in several files, and is still written once.
+
+The files are collapsed in parallel and spread by person over bucket
+files on disk, and then each bucket is merged, so memory holds only
+one bucket at a time. The output is sorted by Wikidata id.
+"""
+
+import csv
+import glob
+import os
+import zlib
+from functools import partial
+
+from wikidata_person_bio import hdr_row, list_results, open_result
+
+FIELDNAMES = hdr_row.split(',')
+SEPARATOR = '|'
+
+
+def person_key(person):
+    """Sort key putting Q2 before Q10"""
+    return len(person), person
+
+
+def bucket_of(person, buckets):
+    """Return the bucket of a person, the same in every process"""
+    return zlib.crc32(person.encode('utf-8')) % buckets
+
+
+def collapse_rows(rows, people):
+    """Add the values of each row to the sets of its person, and count the rows"""
+    row_count = 0
+    for row_count, row in enumerate(rows, 1):
+        values = people.get(row[0])
+        if values is None:
+            values = people[row[0]] = [set() for _col in FIELDNAMES[1:]]
+        for value_set, value in zip(values, row[1:]):
+            if value:
+                value_set.update(value.split(SEPARATOR))
+    return row_count
+
+
+def joined_row(person, values):
+    return [person] + [SEPARATOR.join(sorted(value_set)) for value_set in values]
+
+
+def collapse_result(result, bucket_dir, buckets):
+    """Collapse one downloaded result, and append its people to the bucket files
+
+    Each process has its own bucket files, so no locking is needed.
+    Returns the number of rows and people.
+    """
+    people = {}
+    with open_result(result) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return 0, 0
+        if not header == FIELDNAMES:
+            raise ValueError(f'unexpected columns in {result}: {header}')
+        row_count = collapse_rows(reader, people)
+    by_bucket = {}
+    for person, values in people.items():
+        by_bucket.setdefault(bucket_of(person, buckets), []).append(
+            joined_row(person, values))
+    for bucket, rows in by_bucket.items():
+        bucket_fn = os.path.join(bucket_dir, f'{bucket:04d}-{os.getpid()}.csv')
+        with open(bucket_fn, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+    return row_count, len(people)
+
+
+def merge_bucket(bucket, bucket_dir):
+    """Merge the people of one bucket from every process into one sorted file
+
+    Returns the filename and the number of people.
+    """
+    people = {}
+    for bucket_fn in glob.glob(os.path.join(bucket_dir, f'{bucket:04d}-*.csv')):
+        with open(bucket_fn, newline='', encoding='utf-8') as f:
+            collapse_rows(csv.reader(f), people)
+    out_fn = os.path.join(bucket_dir, f'{bucket:04d}.merged')
+    with open(out_fn, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for person in sorted(people, key=person_key):
+            writer.writerow(joined_row(person, people[person]))
+    return out_fn, len(people)
+
+
+def combine(data_dir, out_fn, workers=1, buckets=64):
+    """Combine the downloaded files in data_dir into out_fn"""
+    import contextlib
+    import heapq
+    import tempfile
+    from multiprocessing import Pool
+    results = list_results(data_dir)
+    print(f'Collapsing {len(results):,} results from {data_dir}')
+    # The buckets add up to about the size of the output, which may be
+    # more than /tmp holds, so they go in the directory of the output.
+    out_dir = os.path.dirname(os.path.abspath(out_fn))
+    with tempfile.TemporaryDirectory(prefix='wd_person_', dir=out_dir) as bucket_dir, \
+            Pool(processes=workers) as pool:
+        # Results and buckets vary a lot in size, so hand them out one
+        # at a time.
+        counts = pool.map(partial(collapse_result, bucket_dir=bucket_dir, buckets=buckets),
+                          results, chunksize=1)
+        print('Read {:,} rows, or {:,} people before merging across files'.format(
+            sum(rows for rows, _people in counts), sum(people for _rows, people in counts)))
+        merged = pool.map(partial(merge_bucket, bucket_dir=bucket_dir),
+                          range(buckets), chunksize=1)
+        print(f'Writing {sum(people for _fn, people in merged):,} people to {out_fn}')
+        # The buckets are sorted, so merging them sorts the whole output,
+        # which is then the same for any number of workers and buckets.
+        with contextlib.ExitStack() as stack, \
+                open(out_fn, 'w', newline='', encoding='utf-8') as f:
+            readers = [csv.reader(stack.enter_context(open(merged_fn, newline='', encoding='utf-8')))
+                       for merged_fn, _people in merged]
+            writer = csv.writer(f)
+            writer.writerow(FIELDNAMES)
+            writer.writerows(heapq.merge(*readers, key=lambda row: person_key(row[0])))
+
+
+def go():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Combine Wikidata person CSV files into one row per person')
+    parser.add_argument(
+        'data_dir', help='data directory of wikidata_person_bio.py')
+    parser.add_argument('out_fn', help='output .csv filename')
+    parser.add_argument('-w', '--workers', help='number of processes',
+                        default=1, type=int)
+    parser.add_argument('-b', '--buckets', help='number of buckets on disk; more buckets use less memory',
+                        default=64, type=int)
+    args = parser.parse_args()
+    combine(args.data_dir, args.out_fn, args.workers, args.buckets)
+
+
+if __name__ == '__main__':
+    go()
@@ -16,7 +16,6 @@ Get the data from here:
 https://fdc.myflorida.com/pub/obis_request.html
 """
 
-import pandas as pd
 import zipfile
 import os
 import sys
@@ -60,6 +59,7 @@ def process_zip_files(directory):
     Args:
         directory (str): The path to the directory containing the zip files.
     """
+    import pandas as pd
 
     all_data = []
     for filename in os.listdir(directory):
@@ -104,4 +104,5 @@ def go():
     df.to_csv(output_fn, index=False)
 
 
-go()
+if __name__ == '__main__':
+    go()
@@ -18,11 +18,10 @@ Download public records data from MicroPact license rosters.
 import csv
 import os
 
-import pandas as pd
-
 
 def download_set(code, url_template, roster_ids, dl_dir):
     """Download a set of files for which mapping is unknown"""
+    import pandas as pd
     for roster_id in roster_ids:
         url = url_template % roster_id
         local_fn = '%s-%d.csv' % (code, roster_id)
@@ -276,6 +275,7 @@ def make_unique(val, seen_vals):
 
 def etl_roster(dl_dir, roster_fn, roster_map):
     """ETL a single roster"""
+    import pandas as pd
     roster_fn = os.path.join(dl_dir, roster_fn)
     print('Processing:', roster_fn)
 
@@ -300,6 +300,7 @@ def etl_roster(dl_dir, roster_fn, roster_map):
 
 def etl_all(dl_dir):
     """ETL all rosters"""
+    import pandas as pd
     col_fn = os.path.join(dl_dir, 'roster_column.csv')
     print('Reading file:', col_fn)
     col_df = pd.read_csv(col_fn, low_memory=False)
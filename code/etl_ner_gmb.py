@@ -14,7 +14,6 @@ https://www.kaggle.com/abhinavwalia95/entity-annotated-corpus/data
 
 """
 
-import pandas as pd
 
 import csv
 import sys
@@ -43,6 +42,7 @@ def process_row(row, writer):
 
 
 def go():
+    import pandas as pd
     if not 3 == len(sys.argv):
         print ('usage: %s input_file.csv output_file.csv' % (sys.argv[0]))
         sys.exit(1)
@@ -28,8 +28,6 @@ import gzip
 import json
 
 
-csv.field_size_limit(sys.maxsize)
-
 # The value id_wikidata (not nested under remote_ids) is defined
 # exactly once out of 6.9M records, and in that case it's redundant
 # to the value nested under remote_ids. It seems to be a mistake,
@@ -61,6 +59,8 @@ def go():
         sys.exit(1)
     txt_gz_fn = sys.argv[1]
     csv_out_fn = sys.argv[2]
+    # the JSON column of some records exceeds the default field limit
+    csv.field_size_limit(sys.maxsize)
     with gzip.open(txt_gz_fn, 'rt') as inf:  # inf= IN File
         reader = csv.reader(inf, delimiter='\t')
         with open(csv_out_fn, 'w') as outf:
@@ -77,4 +77,5 @@ def go():
     print('\nDone.')
 
 
-go()
+if __name__ == '__main__':
+    go()
@@ -16,8 +16,6 @@ https://catalog.data.gov/dataset?res_format=CSV&organization=va-gov&q=gravesite&
 import os
 import urllib.request
 import glob
-import pandas as pd
-import numpy as np
 import sys
 
 
@@ -102,6 +100,8 @@ def calculate_age(born, died):
 
 
 def etl():
+    import pandas as pd
+    import numpy as np
     fnames = glob.glob(os.path.expanduser('~/.cache/va_gravesite_*.csv'))
     if not fnames:
         print('No files found: ~/.cache/va_gravesite_*.csv')
@@ -10,9 +10,13 @@
 """
 ETL Florida voter registration files
 
-1. Read each tab-delimited file
+1. Read each tab-delimited file, optionally in parallel
 2. Narrow down the columns
-3. Output all counties to a single CSV file
+3. Standardize each file
+4. Output all counties to a single CSV file, sorted either in memory
+   or, with --external-sort, on disk in runs that are then merged.
+   Alternatively, output Parquet partitioned by county and birth decade,
+   or only the voters changed since the previous monthly extract.
 
 Source data available here:
 https://dos.fl.gov/elections/data-statistics/voter-registration-statistics/voter-extract-request/
@@ -20,56 +24,188 @@ https://dos.fl.gov/elections/data-statistics/voter-registration-statistics/voter
 
 
 import glob
+import itertools
+import os
 import re
-import sys
+from functools import partial
 
 
-import pandas as pd
-import numpy as np
+COL_NAMES = ['id', 'last', 'suffix', 'first', 'middle',
+             'gender', 'race', 'birth_date_str', 'reg_date_str', 'status']
+USE_COLS = [1, 2, 3, 4, 5, 19, 20, 21, 22, 28]
+# the Parquet output also reads the county code, to partition by it
+COUNTY_COL_NAME = 'county'
+COUNTY_USE_COL = 0
+NOMINAL_COLS = ['gender', 'race', 'suffix', 'status']
+SORT_BY = ['last', 'birth_date', 'first']
+# fields compared between snapshots in delta mode
+DELTA_HASH_COLS = ['last', 'suffix', 'first', 'middle',
+                   'birth_date', 'reg_date', 'status']
+PARQUET_DICTIONARY_COLS = ['last', 'suffix', 'first', 'middle',
+                           'gender', 'status']
+# Field values read as missing by both parsers: the defaults of
+# pd.read_csv(), spelled out because Arrow has a different list.
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+             '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+             'n/a', 'nan', 'null']
+# number of rows pickled at a time in a sorted run
+RUN_CHUNK_ROWS = 10000
+# size of the chunks read by the external sort, in rows for the C
+# parser and in bytes for the Arrow parser
+READ_CHUNK_ROWS = 100000
+READ_CHUNK_BYTES = 32 * 2**20
 
 
-def read_one(in_fn):
+def columns_to_read(with_county=False):
+    """Return the names and positions of the columns to read"""
+    if with_county:
+        return [COUNTY_COL_NAME] + COL_NAMES, [COUNTY_USE_COL] + USE_COLS
+    return COL_NAMES, USE_COLS
+
+
+def pyarrow_csv_options(col_names, use_cols, **read_options):
+    """Return the options of the Arrow CSV reader for the columns"""
+    import pyarrow as pa
+    import pyarrow.csv
+
+    # Arrow names columns f0, f1, ... when there is no header.
+    arrow_names = ['f%d' % i for i in use_cols]
+    # id and race are numeric, so let Arrow infer them as pandas would.
+    column_types = {arrow_name: pa.string()
+                    for arrow_name, col_name in zip(arrow_names, col_names) if col_name not in ('id', 'race')}
+    return {'read_options': pyarrow.csv.ReadOptions(
+                autogenerate_column_names=True, use_threads=True, **read_options),
+            'parse_options': pyarrow.csv.ParseOptions(delimiter='\t'),
+            'convert_options': pyarrow.csv.ConvertOptions(
+                include_columns=arrow_names, column_types=column_types,
+                null_values=NA_VALUES, strings_can_be_null=True)}
+
+
+def pandas_csv_options(col_names, use_cols):
+    """Return the options of pd.read_csv() for the columns"""
+    # Read the text as text, even a column that is empty in every row
+    # of this county, like the Arrow reader.
+    dtype = {col_name: str for col_name in col_names if col_name not in ('id', 'race')}
+    return {'sep': '\t', 'usecols': use_cols, 'names': col_names,
+            'dtype': dtype, 'keep_default_na': False, 'na_values': NA_VALUES,
+            'index_col': None}
+
+
+def read_one_pyarrow(in_fn, with_county=False):
+    """Read a single file with the multi-threaded Arrow CSV parser
+
+    The file is memory-mapped, and only the projected columns are
+    converted, so this is much faster for the large counties.
+    """
+    import pyarrow as pa
+    import pyarrow.csv
+
+    col_names, use_cols = columns_to_read(with_county)
+    table = pyarrow.csv.read_csv(
+        pa.memory_map(in_fn), **pyarrow_csv_options(col_names, use_cols))
+    return table.rename_columns(col_names).to_pandas()
+
+
+def read_one(in_fn, engine='c', with_county=False):
     """Read a single file"""
+    import pandas as pd
     print('Reading Florida tab-delimited file: %s' % in_fn)
-    col_names = ['id', 'last', 'suffix', 'first', 'middle',
-                 'gender', 'race', 'birth_date_str', 'reg_date_str', 'status']
-    df = pd.read_csv(in_fn, sep='\t', usecols=[
-                     1, 2, 3, 4, 5, 19, 20, 21, 22, 28], names=col_names, index_col=None)
+    if engine == 'pyarrow':
+        return read_one_pyarrow(in_fn, with_county)
+    col_names, use_cols = columns_to_read(with_county)
+    df = pd.read_csv(in_fn, **pandas_csv_options(col_names, use_cols))
     return df
 
 
-def clean(df_all):
-    print('head()')
-    print(df_all.head())
+def read_chunks(in_fn, engine='c'):
+    """Read a single file a chunk of rows at a time"""
+    import pandas as pd
+    print('Reading Florida tab-delimited file in chunks: %s' % in_fn)
+    if engine == 'pyarrow':
+        import pyarrow as pa
+        import pyarrow.csv
+        with pyarrow.csv.open_csv(pa.memory_map(in_fn), **pyarrow_csv_options(
+                COL_NAMES, USE_COLS, block_size=READ_CHUNK_BYTES)) as reader:
+            for batch in reader:
+                yield pa.Table.from_batches([batch]).rename_columns(COL_NAMES).to_pandas()
+        return
+    with pd.read_csv(in_fn, chunksize=READ_CHUNK_ROWS,
+                     **pandas_csv_options(COL_NAMES, USE_COLS)) as reader:
+        yield from reader
 
-    print('Summarizing nominal variables')
-    print(df_all.gender.value_counts())
-    print(df_all.race.value_counts())
-    print(df_all.suffix.value_counts())
-    print(df_all.status.value_counts())
 
+def preclean(df):
+    """Standardize a single file, so only compact frames are combined"""
+    import pandas as pd
+    import numpy as np
     print('Standardizing suffix')
-    df_all.loc[df_all.suffix.isin(['JR', 'Jr', 'JR.']), 'suffix'] = 'Jr.'
-    df_all.loc[df_all.suffix.isin(['SR', 'Sr', 'SR.']), 'suffix'] = 'Sr.'
-    df_all.loc[df_all.suffix.isin(['2ND']), 'suffix'] = 'II'
-    df_all.loc[df_all.suffix.isin(['3RD']), 'suffix'] = 'III'
-    df_all.loc[df_all.suffix.isin(['MRS', 'DR.', 'REV']), 'suffix'] = np.nan
-    print(df_all.suffix.value_counts())
+    df.loc[df.suffix.isin(['JR', 'Jr', 'JR.']), 'suffix'] = 'Jr.'
+    df.loc[df.suffix.isin(['SR', 'Sr', 'SR.']), 'suffix'] = 'Sr.'
+    df.loc[df.suffix.isin(['2ND']), 'suffix'] = 'II'
+    df.loc[df.suffix.isin(['3RD']), 'suffix'] = 'III'
+    df.loc[df.suffix.isin(['MRS', 'DR.', 'REV']), 'suffix'] = np.nan
 
     print('Standardizing date')
-    df_all['reg_date'] = pd.to_datetime(
-        df_all['reg_date_str'], format='%m/%d/%Y', errors='coerce')
-    print(f'Registration date range is {df_all.reg_date.min()} to {df_all.reg_date.max()}')
-    df_all['birth_date'] = pd.to_datetime(
-        df_all['birth_date_str'], format='%m/%d/%Y', errors='coerce')
-    print(f'Birth date range is {df_all.birth_date.min()} to {df_all.birth_date.max()}')
-    df_all['birth_month'] = df_all.birth_date.values.astype('datetime64[M]')
+    df['reg_date'] = pd.to_datetime(
+        df['reg_date_str'], format='%m/%d/%Y', errors='coerce')
+    df['birth_date'] = pd.to_datetime(
+        df['birth_date_str'], format='%m/%d/%Y', errors='coerce')
+    df['birth_month'] = df.birth_date.values.astype('datetime64[M]')
 
     print('Cleaning up whitespace')
-    df_all['first'] = df_all['first'].str.strip()
-    df_all['middle'] = df_all['middle'].str.strip()
-    df_all['last'] = df_all['last'].str.strip()
+    df['first'] = df['first'].str.strip()
+    df['middle'] = df['middle'].str.strip()
+    df['last'] = df['last'].str.strip()
+
+    df.drop(['reg_date_str', 'birth_date_str'], axis=1, inplace=True)
+    return df
+
+
+def read_and_preclean(in_fn, engine='c', with_county=False):
+    """Read and standardize a single file
+
+    The date strings are dropped here, so a worker process sends back
+    a smaller frame.
+    """
+    return preclean(read_one(in_fn, engine, with_county))
 
+
+def map_files(func, in_fns, workers):
+    """Call func on each file, in a process pool if workers is more than one
+
+    The results are in the order of the files.
+    """
+    if workers > 1:
+        from multiprocessing import Pool
+        with Pool(processes=workers) as pool:
+            return pool.map(func, in_fns)
+    return [func(in_fn) for in_fn in in_fns]
+
+
+def print_value_counts(value_counts_list):
+    """Print the value counts of the nominal variables summed over files"""
+    import pandas as pd
+    print('Summarizing nominal variables')
+    for col in NOMINAL_COLS:
+        counts = pd.concat([value_counts[col]
+                            for value_counts in value_counts_list])
+        print(counts.groupby(level=0).sum().sort_values(ascending=False))
+
+
+def read_all(in_dir, workers, engine='c'):
+    """Read and standardize all the county files in a directory"""
+    import pandas as pd
+    in_fns = sorted(glob.glob(in_dir+'/*.txt'))
+    df_list = map_files(
+        partial(read_and_preclean, engine=engine), in_fns, workers)
+    print('Combining files')
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+
+def mark_exceptions(df_all):
+    """Flag rows with invalid names or dates in the column exception"""
+    import pandas as pd
+    import numpy as np
     print('Marking exceptions')
     idx_valid_suffix = (df_all.suffix.isin(
         ['Jr.', 'Sr.', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X', '*']) | df_all.suffix.isna())
@@ -98,34 +234,324 @@ def clean(df_all):
         (df_all.birth_date > df_all.reg_date)
     print(f'Exception count: {idx_exception.sum():,} ({100.0*idx_exception.sum()/df_all.shape[0]:.2f})%')
     df_all.loc[idx_exception, 'exception'] = 1
+    return df_all
+
+
+def clean(df_all):
+    print('head()')
+    print(df_all.head())
+
+    print('Summarizing nominal variables')
+    for col in NOMINAL_COLS:
+        print(df_all[col].value_counts())
+
+    print(f'Registration date range is {df_all.reg_date.min()} to {df_all.reg_date.max()}')
+    print(f'Birth date range is {df_all.birth_date.min()} to {df_all.birth_date.max()}')
+
+    df_all = mark_exceptions(df_all)
 
-    df_all = df_all.sort_values(by=['last', 'birth_date', 'first'])
-    df_all.drop(['reg_date_str', 'birth_date_str',
-                 'birth_date'], axis=1, inplace=True)
+    df_all = df_all.sort_values(by=SORT_BY)
+    df_all.drop(['birth_date'], axis=1, inplace=True)
     return df_all
 
 
+def write_run(run, run_dir):
+    """Sort a run and write it to disk, returning its filename"""
+    import pickle
+    import tempfile
+    run = run.sort_values(by=SORT_BY)
+    fd, run_fn = tempfile.mkstemp(suffix='.run', dir=run_dir)
+    with open(fd, 'wb') as f:
+        for chunk_start in range(0, run.shape[0], RUN_CHUNK_ROWS):
+            chunk = run.iloc[chunk_start:chunk_start+RUN_CHUNK_ROWS]
+            pickle.dump(list(chunk.itertuples(index=False, name=None)), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    return run_fn
+
+
+def write_runs(in_fn, run_dir, engine='c', memory_mb=512):
+    """Clean one file and write it to disk as sorted runs
+
+    This is the first phase of the external sort. The file is read and
+    cleaned a chunk at a time, and the chunks make up a run until they
+    fill the memory budget, so a large county is never in memory at
+    once. The runs are written in the order of the input rows, which
+    keeps the merge stable like the in-memory sort.
+
+    Returns the column names, the run filenames, and the value counts
+    of the nominal variables of each chunk.
+    """
+    import pandas as pd
+    columns = []
+    run_fns = []
+    value_counts_list = []
+    run = []
+    run_bytes = 0
+    for df in read_chunks(in_fn, engine):
+        df = mark_exceptions(preclean(df))
+        columns = list(df.columns)
+        value_counts_list.append({col: df[col].value_counts() for col in NOMINAL_COLS})
+        run.append(df)
+        run_bytes += df.memory_usage(deep=True).sum()
+        if run_bytes >= memory_mb * 2**20:
+            run_fns.append(write_run(pd.concat(run), run_dir))
+            run = []
+            run_bytes = 0
+    if run:
+        run_fns.append(write_run(pd.concat(run), run_dir))
+    return columns, run_fns, value_counts_list
+
+
+def read_run(run_fn):
+    """Yield the rows of a sorted run"""
+    import pickle
+    with open(run_fn, 'rb') as f:
+        while True:
+            try:
+                rows = pickle.load(f)
+            except EOFError:
+                return
+            yield from rows
+
+
+def merge_runs(columns, run_fns, out_fn):
+    """Merge sorted runs into the final CSV file
+
+    This is the second phase of the external sort. Like
+    DataFrame.sort_values(), missing values sort last.
+    """
+    import heapq
+    import pandas as pd
+    key_idx = [columns.index(col) for col in SORT_BY]
+
+    def sort_key(row):
+        key = []
+        for i in key_idx:
+            value = row[i]
+            # NaN and NaT are not equal to themselves.
+            if value is None or value != value:
+                key.append((True, None))
+            else:
+                key.append((False, value))
+        return key
+
+    merged = heapq.merge(*[read_run(run_fn)
+                           for run_fn in run_fns], key=sort_key)
+    with open(out_fn, 'w', newline='') as f:
+        header = True
+        while True:
+            rows = list(itertools.islice(merged, RUN_CHUNK_ROWS))
+            if not rows and not header:
+                break
+            df = pd.DataFrame.from_records(rows, columns=columns)
+            df.drop(['birth_date'], axis=1, inplace=True)
+            df.to_csv(f, index=False, header=header, float_format='%.0f')
+            header = False
+
+
+def external_sort(in_dir, out_fn, workers, engine='c', memory_mb=512):
+    """Clean, sort and write all the files without holding them in memory"""
+    import tempfile
+    in_fns = sorted(glob.glob(in_dir+'/*.txt'))
+    # Put the runs beside the output, which presumably has room for them.
+    out_dir = os.path.dirname(os.path.abspath(out_fn))
+    with tempfile.TemporaryDirectory(prefix='fl_sort_', dir=out_dir) as run_dir:
+        results = map_files(partial(write_runs, run_dir=run_dir,
+                                    engine=engine, memory_mb=memory_mb), in_fns, workers)
+        print_value_counts([value_counts for _columns, _run_fns, value_counts_list in results
+                            for value_counts in value_counts_list])
+
+        # an empty file has no chunks, so no columns
+        columns = next(columns for columns, _run_fns, _value_counts_list in results if columns)
+        run_fns = [run_fn for _columns, file_run_fns,
+                   _value_counts in results for run_fn in file_run_fns]
+        print(f'Merging {len(run_fns):,} sorted runs to CSV file: {out_fn}')
+        merge_runs(columns, run_fns, out_fn)
+
+
+def group_by_county(in_fns):
+    """Group the files by the county code their names start with, as in ALA_20190212.txt"""
+    groups = {}
+    for in_fn in in_fns:
+        groups.setdefault(os.path.basename(in_fn).split('_')[0], []).append(in_fn)
+    for county, county_fns in groups.items():
+        if len(county_fns) > 1:
+            print(f'County {county} has {len(county_fns)} files, which are written together')
+    return list(groups.values())
+
+
+def write_partitions(in_fns, out_dir, engine='c'):
+    """Clean the files of one county and write them as Parquet partitioned by county and birth decade
+
+    Each call owns the partitions of its county, so it first removes
+    them, including decades from an earlier run that are now empty.
+    Name columns are dictionary-encoded, and dates are typed, so the
+    output needs no float_format to keep the id an integer.
+
+    Returns the value counts of the nominal variables.
+    """
+    import shutil
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet
+
+    df = pd.concat([mark_exceptions(read_and_preclean(in_fn, engine, with_county=True))
+                    for in_fn in in_fns], ignore_index=True)
+    df = df.sort_values(by=SORT_BY)
+    # A plain integer, because pandas cannot read back a nullable one
+    # from the partition names; decade 0 has the unknown birth dates.
+    df['birth_decade'] = (df.birth_date.dt.year // 10 * 10).fillna(0).astype('int16')
+    df['id'] = df['id'].astype('Int64')
+    df['exception'] = df['exception'] == 1
+    for col in PARQUET_DICTIONARY_COLS:
+        df[col] = df[col].astype('category')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in ('reg_date', 'birth_date', 'birth_month'):
+        table = table.set_column(table.schema.get_field_index(col), col,
+                                 table[col].cast(pa.timestamp('s')).cast(pa.date32()))
+    for county in df.county.dropna().unique():
+        shutil.rmtree(os.path.join(out_dir, f'county={county}'), ignore_errors=True)
+    pyarrow.parquet.write_to_dataset(table, out_dir, partition_cols=['county', 'birth_decade'],
+                                     use_dictionary=PARQUET_DICTIONARY_COLS)
+    return {col: df[col].value_counts() for col in NOMINAL_COLS}
+
+
+def write_parquet(in_dir, out_dir, workers, engine='c'):
+    """Clean and write all the files as a partitioned Parquet data set
+
+    Read it back with a filter to touch only some partitions, such as
+
+    pd.read_parquet(out_dir, columns=['first', 'last'],
+        filters=[('birth_decade', '=', 1950), ('first', '=', 'JOHN')])
+    """
+    in_fns = sorted(glob.glob(in_dir+'/*.txt'))
+    print(f'Writing to Parquet directory: {out_dir}')
+    # Files of the same county, such as an older extract, would replace
+    # each other's partitions, so each county is written by one call.
+    value_counts_list = map_files(
+        partial(write_partitions, out_dir=out_dir, engine=engine), group_by_county(in_fns), workers)
+    print_value_counts(value_counts_list)
+
+
+def hash_rows(df):
+    """Hash the name, date and status fields of each voter"""
+    import pandas as pd
+    df_hash = df[DELTA_HASH_COLS].copy()
+    for col in ('birth_date', 'reg_date'):
+        # days since epoch does not depend on the datetime resolution
+        df_hash[col] = df[col].values.astype('datetime64[D]').astype('int64')
+    return pd.Series(pd.util.hash_pandas_object(df_hash, index=False).values, index=df['id'].values)
+
+
+def load_delta_index(index_fn):
+    """Load the voter hashes from the previous run as a Series indexed by id"""
+    import pandas as pd
+    import numpy as np
+    if not os.path.exists(index_fn):
+        print(f'No previous index {index_fn}, so all voters are added')
+        return pd.Series([], dtype='uint64')
+    with np.load(index_fn) as npz:
+        return pd.Series(npz['hashes'], index=npz['ids'])
+
+
+def save_delta_index(hashes, index_fn):
+    """Save the voter hashes for the next run"""
+    import numpy as np
+    tmp_fn = index_fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, ids=hashes.index.values, hashes=hashes.values)
+    os.replace(tmp_fn, index_fn)
+
+
+def write_delta(in_dir, out_fn, index_fn, workers, engine='c'):
+    """Write only voters added, removed or changed since the previous run
+
+    The index keeps a 64-bit hash of each voter, keyed by id. Only the
+    added and changed voters are cleaned and written in full. The
+    removed voters have only the id. The column change tells which
+    is which.
+    """
+    import pandas as pd
+    import numpy as np
+    df_all = read_all(in_dir, workers, engine)
+    hashes = hash_rows(df_all)
+    is_duplicate = hashes.index.duplicated(keep='last')
+    if is_duplicate.any():
+        print(f'Keeping the last of {is_duplicate.sum():,} duplicate ids')
+        df_all = df_all[~is_duplicate]
+        hashes = hashes[~is_duplicate]
+    prev_hashes = load_delta_index(index_fn)
+
+    is_added = ~hashes.index.isin(prev_hashes.index)
+    is_changed = ~is_added & (hashes.values !=
+                              prev_hashes.reindex(hashes.index).values)
+    removed_ids = prev_hashes.index[~prev_hashes.index.isin(hashes.index)]
+    print(f'Added: {is_added.sum():,}; changed: {is_changed.sum():,}; removed: {len(removed_ids):,}; unchanged: {(~is_added & ~is_changed).sum():,}')
+
+    df_delta = df_all[is_added | is_changed].copy()
+    df_delta['change'] = np.where(
+        is_added[is_added | is_changed], 'added', 'changed')
+    if df_delta.empty:
+        # the columns clean() would give, so the header is always the same
+        df_delta = df_delta.drop(['birth_date'], axis=1)
+        df_delta['exception'] = np.nan
+    else:
+        df_delta = clean(df_delta)
+    df_removed = pd.DataFrame({'id': removed_ids, 'change': 'removed'})
+    df_delta = pd.concat([df_delta, df_removed], ignore_index=True)
+
+    print('Writing to CSV file: %s' % out_fn)
+    df_delta.to_csv(out_fn, index=False, float_format='%.0f')
+    print(f'Writing index: {index_fn}')
+    save_delta_index(hashes, index_fn)
+
+
 def go():
     """The main loop"""
-    if not len(sys.argv) == 3:
-        print('As arguments pass (1) the directory of the Florida .txt files and (2) the output .csv filename.')
-        print('Example: python3 %s /tmp/florida/ /tmp/fl.csv' % sys.argv[0])
-        sys.exit(1)
-    in_dir = sys.argv[1]
-    out_fn = sys.argv[2]
-    print('in_dir=', in_dir)
-    print('out_fn=', out_fn)
-    df_list = []
-    for in_fn in glob.glob(in_dir+'/*.txt'):
-        df = read_one(in_fn)
-        df_list.append(df)
-    print('Combining files')
-    df_all = pd.concat(df_list, axis=0, ignore_index=True)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='ETL Florida voter registration files into a single CSV file')
+    parser.add_argument(
+        'in_dir', help='directory of the Florida .txt files')
+    parser.add_argument(
+        'out_fn', help='output .csv filename, or directory with --format parquet')
+    parser.add_argument('-w', '--workers',
+                        help='number of processes reading the county files', default=1, type=int)
+    parser.add_argument('-e', '--engine', choices=('c', 'pyarrow'), default='c',
+                        help='CSV parser: the pandas C parser or the multi-threaded Arrow parser (requires pyarrow)')
+    parser.add_argument('-x', '--external-sort', action='store_true',
+                        help='sort on disk instead of in memory')
+    parser.add_argument('-m', '--memory-mb', default=512, type=int,
+                        help='memory budget in megabytes for each sorted run with --external-sort')
+    parser.add_argument('-f', '--format', choices=('csv', 'parquet'), default='csv',
+                        help='output a single CSV file or Parquet partitioned by county and birth decade (requires pyarrow)')
+    parser.add_argument('-d', '--delta-index',
+                        help='output only the voters changed since the run that wrote this index (.npz), and then update it')
+    args = parser.parse_args()
+    if args.delta_index and (args.external_sort or not args.format == 'csv'):
+        parser.error(
+            '--delta-index works with neither --external-sort nor --format parquet')
+    print('in_dir=', args.in_dir)
+    print('out_fn=', args.out_fn)
+    if args.delta_index:
+        write_delta(args.in_dir, args.out_fn, args.delta_index,
+                    args.workers, args.engine)
+        return
+    if args.format == 'parquet':
+        write_parquet(args.in_dir, args.out_fn, args.workers, args.engine)
+        return
+    if args.external_sort:
+        external_sort(args.in_dir, args.out_fn, args.workers,
+                      args.engine, args.memory_mb)
+        return
+
+    df_all = read_all(args.in_dir, args.workers, args.engine)
 
     df_all = clean(df_all)
 
-    print('Writing to CSV file: %s' % out_fn)
-    df_all.to_csv(out_fn, index=False, float_format='%.0f')
+    print('Writing to CSV file: %s' % args.out_fn)
+    df_all.to_csv(args.out_fn, index=False, float_format='%.0f')
 
 
-go()
+if __name__ == '__main__':
+    go()
@@ -14,6 +14,15 @@ ETL North Carolina voter registration files
 2. Narrow down the columns
 3. Output all counties to a single CSV file
 
+With --chunksize, the file is processed in chunks to use constant memory.
+
+With --compact, codes are read as categoricals and names as Arrow-backed
+strings, which takes much less memory than Python strings.
+
+With --snapshots, a directory of snapshots is compacted into one history
+table with the first and last snapshot in which each voter (by ncid) had
+each version of the name.
+
 
 # Source data available here
 
@@ -40,11 +49,6 @@ https://s3.amazonaws.com/dl.ncsbe.gov/data/Snapshots/layout_VR_Snapshot.txt
 
 """
 
-
-import glob
-import sys
-import pandas as pd
-
 FILE_ENCODING = 'iso-8859-1'
 FILE_SEP = '\t'
 COL_NAME_MAP = {
@@ -54,53 +58,236 @@ COL_NAME_MAP = {
 }
 
 
+WANT_COLS = ['county_id', 'voter_reg_num', 'ncid', 'status_cd', 'name_prefx_cd', 'last_name', 'first_name',
+             'middle_name', 'midl_name', 'name_suffix_lbl', 'name_sufx_cd', 'race_code', 'ethnic_code', 'gender_code', 'sex_code']
+COUNT_COLS = ['status_cd', 'race_code', 'ethnic_code', 'gender_code']
+# a name version is a distinct combination of these
+HISTORY_KEY_COLS = ['ncid', 'last_name', 'first_name',
+                    'middle_name', 'name_suffix_lbl']
+# the key columns before standardizing the names of columns
+HISTORY_READ_COLS = HISTORY_KEY_COLS + list(COL_NAME_MAP)
+
+
+# low-cardinality codes read as categoricals with --compact
+CODE_COLS = ['county_id', 'status_cd', 'name_prefx_cd', 'name_suffix_lbl', 'name_sufx_cd',
+             'race_code', 'ethnic_code', 'gender_code', 'sex_code']
+# names read as Arrow-backed strings with --compact
+NAME_COLS = ['ncid', 'last_name', 'first_name', 'middle_name', 'midl_name']
+
+
 def groupby(df, col):
-    gb = df.groupby(col)[[col]].count()
+    # observed=True omits unused categories with --compact
+    gb = df.groupby(col, observed=True)[[col]].count()
     print(gb)
 
 
-def go():
-    """The main loop"""
-    if not len(sys.argv) == 3:
-        print('As arguments pass (1) the state-wide NC voter registration file and (2) the output .csv filename.')
-        print('Example: python3 %s ncvoter_Statewide.txt nc.csv' % sys.argv[0])
-        sys.exit(1)
-    in_fn = sys.argv[1]
-    out_fn = sys.argv[2]
-    want_cols = ['county_id', 'voter_reg_num', 'ncid', 'status_cd', 'name_prefx_cd', 'last_name', 'first_name',
-                 'middle_name', 'midl_name', 'name_suffix_lbl', 'name_sufx_cd', 'race_code', 'ethnic_code', 'gender_code', 'sex_code']
-    print(f'Reading tab-delimited file: {in_fn}')
+def compact_dtypes(use_cols):
+    """Return the dtypes for --compact"""
+    dtypes = {col: 'category' for col in CODE_COLS if col in use_cols}
+    dtypes.update(
+        {col: 'string[pyarrow]' for col in NAME_COLS if col in use_cols})
+    return dtypes
+
+
+def strip_column(s):
+    """Trim whitespace from text, string or categorical values"""
+    import pandas as pd
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # Strip the few categories instead of every value. Stripping
+        # may make two categories equal, so map them.
+        stripped = s.cat.categories.str.strip()
+        if stripped.is_unique:
+            return s.cat.rename_categories(stripped)
+        return s.map(dict(zip(s.cat.categories, stripped))).astype('category')
+    return s.str.strip()
+
+
+def get_use_cols(in_fn):
+    """Read the header and return the wanted columns that the file has"""
+    import pandas as pd
     df_header = pd.read_csv(in_fn, sep=FILE_SEP,
                             encoding=FILE_ENCODING, nrows=0)
     has_cols = df_header.columns
-    use_cols = list(set(want_cols) & set(has_cols))
-    missing_cols = list(set(want_cols) - set(has_cols))
+    use_cols = list(set(WANT_COLS) & set(has_cols))
+    missing_cols = list(set(WANT_COLS) - set(has_cols))
     print(f'File has columns: {has_cols}')
     print(f'Columns are missing: {missing_cols}')
     print(f'Using columns: {use_cols}')
+    return use_cols
 
-    import csv
-    df = pd.read_csv(in_fn, sep=FILE_SEP, encoding=FILE_ENCODING,
-                     usecols=use_cols, on_bad_lines='warn', quoting=csv.QUOTE_NONE)
-    print('Row count: {:,}'.format(df.shape[0]))
 
-    print('Trimming whitespace')
-    string_cols = df.select_dtypes(include=['object'])
-    string_cols = string_cols.apply(lambda x: x.str.strip())
-    df[string_cols.columns] = string_cols
+def standardize(df, verbose=True):
+    """Trim whitespace and standardize the names of columns"""
+    if verbose:
+        print('Trimming whitespace')
+    for col in df.select_dtypes(include=['object', 'string', 'category']).columns:
+        df[col] = strip_column(df[col])
 
-    print('Standardizing the names of columns')
+    if verbose:
+        print('Standardizing the names of columns')
     for old_col, new_col in COL_NAME_MAP.items():
-        if old_col in has_cols:
-            print(f'Renaming {old_col} to {new_col}')
+        if old_col in df.columns:
+            if verbose:
+                print(f'Renaming {old_col} to {new_col}')
             df.rename(columns={old_col: new_col}, inplace=True)
+    return df
+
+
+def go_chunked(in_fn, out_fn, use_cols, chunksize):
+    """Process the file in chunks to use constant memory
+
+    Every value is read as text, so numbers keep leading zeros, and
+    the counts are accumulated one chunk at a time.
+    """
+    import pandas as pd
+    import csv
+    counts = {}
+    row_count = 0
+    reader = pd.read_csv(in_fn, sep=FILE_SEP, encoding=FILE_ENCODING,
+                         usecols=use_cols, on_bad_lines='warn', quoting=csv.QUOTE_NONE,
+                         dtype=str, chunksize=chunksize)
+    print(f'Writing to CSV file: {out_fn}')
+    for chunk_i, df in enumerate(reader):
+        df = standardize(df, verbose=(chunk_i == 0))
+        for col in COUNT_COLS:
+            chunk_counts = df.groupby(col)[col].count()
+            if col in counts:
+                chunk_counts = counts[col].add(chunk_counts, fill_value=0)
+            counts[col] = chunk_counts
+        # encoding defaults to utf-8
+        df.to_csv(out_fn, index=False, mode='a' if chunk_i else 'w',
+                  header=(chunk_i == 0))
+        row_count += df.shape[0]
+        print('.', end='', flush=True)
+    print('\nRow count: {:,}'.format(row_count))
+
+    for col in COUNT_COLS:
+        print(counts[col].astype('int64').to_frame())
+
+
+def get_snapshot_date(in_fn):
+    """Return the date in a snapshot filename such as VR_20051125.txt, or None"""
+    import os
+    import re
+    match = re.search(r'(\d{8})', os.path.basename(in_fn))
+    return match.group(1) if match else None
+
+
+def read_snapshot_names(in_fn, chunksize=1000000):
+    """Read the distinct name versions of each voter in one snapshot
+
+    Duplicates are dropped from each chunk as it is read, so a snapshot
+    takes little more memory than one chunk and its distinct names.
+    """
+    import pandas as pd
+    import csv
+    snapshot_date = get_snapshot_date(in_fn)
+    print(f'Reading snapshot {snapshot_date}: {in_fn}')
+    use_cols = [col for col in get_use_cols(in_fn) if col in HISTORY_READ_COLS]
+    reader = pd.read_csv(in_fn, sep=FILE_SEP, encoding=FILE_ENCODING,
+                         usecols=use_cols, on_bad_lines='warn', quoting=csv.QUOTE_NONE,
+                         dtype=str, chunksize=chunksize)
+    df_list = []
+    for df in reader:
+        df = standardize(df, verbose=False)
+        df_list.append(df[HISTORY_KEY_COLS].fillna('').drop_duplicates())
+    df = pd.concat(df_list, ignore_index=True).drop_duplicates()
+    df['first_snapshot'] = snapshot_date
+    df['last_snapshot'] = snapshot_date
+    return df
+
+
+def compact_history(df):
+    """Keep one row per voter and name version with the snapshots it spans"""
+    return df.groupby(HISTORY_KEY_COLS, as_index=False).agg(
+        first_snapshot=('first_snapshot', 'min'), last_snapshot=('last_snapshot', 'max'))
+
+
+def fold_snapshots(results):
+    """Fold each snapshot into the history as it arrives to keep memory small"""
+    import pandas as pd
+    history = None
+    for df in results:
+        if history is not None:
+            df = pd.concat([history, df], ignore_index=True)
+        history = compact_history(df)
+        print(f'History has {history.shape[0]:,} name versions of {history.ncid.nunique():,} voters')
+    return history
+
+
+def go_snapshots(in_dir, out_fn, workers):
+    """Compact a directory of snapshots into one history table keyed by ncid"""
+    import glob
+    import sys
+    in_fns = []
+    for in_fn in sorted(glob.glob(in_dir + '/*.txt') + glob.glob(in_dir + '/*.zip')):
+        if get_snapshot_date(in_fn):
+            in_fns.append(in_fn)
+        else:
+            print(f'Skipping {in_fn}, which has no date such as 20051125 in its name')
+    print(f'Found {len(in_fns)} snapshots')
+    if not in_fns:
+        print(f'No snapshots in {in_dir}, so nothing to write')
+        sys.exit(1)
+    if workers > 1:
+        from multiprocessing import Pool
+        with Pool(processes=workers) as pool:
+            history = fold_snapshots(pool.imap_unordered(read_snapshot_names, in_fns))
+    else:
+        history = fold_snapshots(map(read_snapshot_names, in_fns))
+    print(f'Writing to CSV file: {out_fn}')
+    history.sort_values(by=['ncid', 'first_snapshot']).to_csv(
+        out_fn, index=False)
+
+
+def go():
+    """The main loop"""
+    import pandas as pd
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='ETL the North Carolina voter registration file into a CSV file')
+    parser.add_argument(
+        'in_fn', help='state-wide NC voter registration file such as ncvoter_Statewide.txt, or directory with --snapshots')
+    parser.add_argument('out_fn', help='output .csv filename')
+    parser.add_argument('-c', '--chunksize', type=int,
+                        help='process this many rows at a time to use constant memory')
+    parser.add_argument('-s', '--snapshots', action='store_true',
+                        help='compact a directory of snapshots into a history of names by ncid')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='number of snapshots to read in parallel with --snapshots')
+    parser.add_argument('--compact', action='store_true',
+                        help='read codes as categoricals and names as Arrow strings to use much less memory (requires pyarrow)')
+    args = parser.parse_args()
+    if args.compact and (args.chunksize or args.snapshots):
+        parser.error('--compact works with neither --chunksize nor --snapshots')
+    in_fn = args.in_fn
+    out_fn = args.out_fn
+    if args.snapshots:
+        go_snapshots(in_fn, out_fn, args.workers)
+        return
+    print(f'Reading tab-delimited file: {in_fn}')
+    use_cols = get_use_cols(in_fn)
+
+    if args.chunksize:
+        go_chunked(in_fn, out_fn, use_cols, args.chunksize)
+        return
+
+    import csv
+    dtypes = compact_dtypes(use_cols) if args.compact else None
+    df = pd.read_csv(in_fn, sep=FILE_SEP, encoding=FILE_ENCODING,
+                     usecols=use_cols, on_bad_lines='warn', quoting=csv.QUOTE_NONE,
+                     dtype=dtypes)
+    print('Row count: {:,}'.format(df.shape[0]))
+    print('Memory usage: {:,} bytes'.format(
+        df.memory_usage(deep=True).sum()))
+
+    df = standardize(df)
 
-    groupby(df, 'status_cd')
-    groupby(df, 'race_code')
-    groupby(df, 'ethnic_code')
-    groupby(df, 'gender_code')
+    for col in COUNT_COLS:
+        groupby(df, col)
     print(f'Writing to CSV file: {out_fn}')
     df.to_csv(out_fn, index=False)  # encoding defaults to utf-8
 
 
-go()
+if __name__ == '__main__':
+    go()
@@ -9,7 +9,12 @@
 This script reads church names from STDIN. The input format is one church name
 per line. It is not a CSV, so there is neither a header nor any commas.
 
-It output format is XML to train a model for probablepeople.
+It output format is XML to train a model for probablepeople. Each name is
+written as soon as it is labeled, so memory use is constant.
+
+Names may also come from files, including a column of a CSV file. For large
+lists, --workers labels batches of lines in parallel and writes them in the
+order of the input.
 
 The labeling rules are not perfect, so manually check the labels.
 
@@ -17,47 +22,146 @@ This script works with Python 3.6.
 """
 
 import fileinput
+import sys
 
-org_tokens = [
+# Phrases may have several words, such as "assembly of god", and
+# then every word is labeled as part of the organization.
+org_phrases = [
     'abbey',
+    'assemblies of god',
+    'assembly of god',
     'baptist',
     'basilica',
     'cathedral',
     'catholic',
     'chapel',
     'church',
+    'church of christ',
+    'church of god',
     'co-cathedral',
-    'episcopal ',
-    'evangelical ',
+    'episcopal',
+    'evangelical',
+    'first baptist',
     'lutheran',
     'methodist',
-    'mission'
+    'mission',
     'parish',
     'parsonage',
     'universalist',
 ]
 
+# marks the end of a phrase in the lexicon
+END = None
+
+
+def build_lexicon(phrases):
+    """Build a trie of nested dictionaries keyed by lowercase token"""
+    lexicon = {}
+    for phrase in phrases:
+        node = lexicon
+        for token in phrase.lower().split():
+            node = node.setdefault(token, {})
+        node[END] = True
+    return lexicon
+
+
+org_lexicon = build_lexicon(org_phrases)
+
+
+def match_length(tokens, start):
+    """Return the number of tokens in the longest phrase beginning at start"""
+    node = org_lexicon
+    length = 0
+    for i in range(start, len(tokens)):
+        node = node.get(tokens[i].lower())
+        if node is None:
+            break
+        if END in node:
+            length = i - start + 1
+    return length
+
 
 def label_church(s):
     labels = []
-    for token in s.split(' '):
-        if token.lower() in org_tokens:
-            label = '<CorporationNameOrganization>%s</CorporationNameOrganization>' % token
-        else:
-            label = '<CorporationName>%s</CorporationName>' % token
-        labels.append(label)
+    tokens = s.split(' ')
+    i = 0
+    while i < len(tokens):
+        length = match_length(tokens, i)
+        for token in tokens[i:i + length]:
+            labels.append(
+                '<CorporationNameOrganization>%s</CorporationNameOrganization>' % token)
+        if not length:
+            labels.append('<CorporationName>%s</CorporationName>' % tokens[i])
+            length = 1
+        i += length
     label = '    <Name>%s</Name>' % ' '.join(labels)
     return label
 
 
-labels = []
-for line in fileinput.input():
-    line = line.replace('\n', '')
-    if not line.strip():
-        # blank
-        continue
-    label = label_church(line)
-    labels.append(label)
+def label_batch(lines):
+    """Label a batch of lines and return the output as one string
+
+    One string per batch is cheaper to send back from the pool than a
+    string per line.
+    """
+    out = []
+    for line in lines:
+        line = line.replace('\n', '')
+        if not line.strip():
+            # blank
+            continue
+        out.append(label_church(line) + '\n')
+    return ''.join(out)
+
+
+def read_names(files, column):
+    """Yield one name per line, or the given column of CSV files"""
+    if not column:
+        yield from fileinput.input(files)
+        return
+    import csv
+    for fn in files or ['-']:
+        f = sys.stdin if fn == '-' else open(fn, encoding='utf-8', newline='')
+        with f:
+            for row in csv.DictReader(f):
+                yield row[column]
+
+
+def batches(lines, batch_size):
+    """Split lines into lists of batch_size lines"""
+    import itertools
+    lines = iter(lines)
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Label church names as XML for training probablepeople')
+    parser.add_argument('files', nargs='*',
+                        help='files of names, one per line (default: STDIN)')
+    parser.add_argument('-c', '--column',
+                        help='read names from this column of CSV files, such as name in data/wikidata-church.csv')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='number of processes labeling batches of lines')
+    parser.add_argument('-b', '--batch-size', default=10000, type=int,
+                        help='number of lines in each batch with --workers')
+    args = parser.parse_args()
+    names = read_names(args.files, args.column)
+    if args.workers > 1:
+        from multiprocessing import Pool
+        with Pool(processes=args.workers) as pool:
+            # imap() returns the batches in input order.
+            for out in pool.imap(label_batch, batches(names, args.batch_size)):
+                sys.stdout.write(out)
+    else:
+        for name in names:
+            sys.stdout.write(label_batch([name]))
+
 
-for label in labels:
-    print (label)
+if __name__ == '__main__':
+    main()
@@ -7,66 +7,137 @@
 """
 Run the CMS Physician data set through probablepeople
 and check for errors
+
+With --analyze, the error flags are computed column-wise over an
+already tagged file, and the error rates by tag type, credential and
+suffix are written as a report. For a file tagged with --sparse, pass
+the same --sparse file, and the tag columns the checks need are
+rebuilt from it.
 """
 
-import probablepeople as pp
-import csv
-from collections import OrderedDict
+import tag_csv
 
 in_fn = '../data/cms-physician-permutation.csv'
 
 out_fn = '../data/cms-physician-permutation-tagged.csv'
 
-tagged_rows = []
-tags = set()
-
-print 'Reading and parsing'
-with open(in_fn, 'rb') as incsvfile:
-    reader = csv.DictReader(incsvfile, delimiter=',')
-    counter = 0
-    for row in reader:
-        # stop early for development
-        #if counter > 1000:
-        #    break
-        try:
-            tagged = pp.tag(row['name'])
-            # add t_ prefix to distinguish
-            tagged0 = OrderedDict(('t_'+k, v) for k, v in tagged[0].viewitems())
-            # add type
-            tagged0['tag_type'] = tagged[1]
-            # add to dictionary of input values
-            row.update(tagged0)
-        except pp.RepeatedLabelError:
-            row['tag_type'] = 'RepeatedLabelError'
-        [tags.add(t) for t in row.keys()]
-        tagged_rows.append(row)
-        counter = counter + 1
-
-print 'Read {:,} rows'.format(counter)
-        
-print 'Writing output'
-initial_keys = reader.fieldnames # preserve the original order of field names
-error_keys = ['error_found_second_entity', 'error_surname', 'error_tag_type' ,'error_any']
-tags_unique = [tag for tag in tags if not tag in initial_keys]
-out_fields = initial_keys + tags_unique + error_keys
+error_keys = ['error_found_second_entity', 'error_surname', 'error_tag_type', 'error_any']
+
 
 def check_row(row):
     # ignore the second marital prefix
     row.pop('t_SecondPrefixMarital', None)
     # second person or second corporation
-    row['error_found_second_entity'] = any([k.find('Second')> -1 for k in row.keys()])
+    row['error_found_second_entity'] = any([k.find('Second') > -1 for k in row.keys()])
     # surname missing or different
     row['error_surname'] = 't_Surname' not in row.keys() or not row['last_name'] == row['t_Surname']
     # not a person (i.e., corporation or RepeatedLabelError)
     # Household can be OK because we added prefixes like "Mr. & Mrs."
-    row['error_tag_type'] = not row['tag_type']  in ('Person', 'Household')
+    row['error_tag_type'] = not row['tag_type'] in ('Person', 'Household')
     # any error
     row['error_any'] = any([row[k] for k in row.keys() if k.startswith('error_')])
     return row
 
-with open(out_fn, 'wb') as outcsvfile:
-    writer = csv.DictWriter(outcsvfile, fieldnames=out_fields)
-    writer.writeheader()
-    for tagged_row in tagged_rows:
-        checked_row = check_row(tagged_row)
-        writer.writerow(checked_row)
\ No newline at end of file
+
+def check_frame(df):
+    """Compute the error flags of check_row() column-wise over a tagged frame
+
+    Missing tags must be NaN, not empty strings.
+    """
+    # second person or second corporation, ignoring the second marital prefix
+    second_cols = [col for col in df.columns if col.startswith('t_') and
+                   'Second' in col and not col == 't_SecondPrefixMarital']
+    df['error_found_second_entity'] = df[second_cols].notna().any(axis=1)
+    # surname missing or different
+    if 't_Surname' not in df.columns:
+        raise ValueError('no t_Surname column: for a file tagged with --sparse, '
+                         'pass the same --sparse file')
+    df['error_surname'] = df.t_Surname.isna() | (
+        df.last_name != df.t_Surname)
+    # not a person (i.e., corporation or RepeatedLabelError)
+    df['error_tag_type'] = ~df.tag_type.isin(('Person', 'Household'))
+    # any error
+    df['error_any'] = df[error_keys[:-1]].any(axis=1)
+    return df
+
+
+def error_report(df, by_cols=('tag_type', 'credential', 'suffix')):
+    """Summarize the error rates of each value of each column in by_cols"""
+    import pandas as pd
+    reports = []
+    for col in by_cols:
+        gb = df.groupby(df[col].fillna('(blank)'))
+        report = gb[error_keys].mean()
+        report.insert(0, 'rows', gb.size())
+        report.insert(0, 'value', report.index)
+        report.insert(0, 'column', col)
+        reports.append(report)
+    return pd.concat(reports, ignore_index=True)
+
+
+def is_checked_tag(col):
+    """Tell whether check_frame() needs the tag column"""
+    return col == 't_Surname' or (col.startswith('t_') and 'Second' in col)
+
+
+def read_sparse_tags(sparse_fn):
+    """Read the tags check_frame() needs from a sparse file as wide t_ columns by row_id"""
+    import pandas as pd
+    print('Reading sparse tags: %s' % sparse_fn)
+    if sparse_fn.endswith('.parquet'):
+        sparse = pd.read_parquet(sparse_fn)
+        sparse['label'] = sparse.label.astype(str)
+    else:
+        sparse = pd.read_csv(sparse_fn, dtype={'label': str, 'value': str},
+                             keep_default_na=False, na_values=[''])
+    sparse['label'] = 't_' + sparse.label
+    sparse = sparse[sparse.label.map(is_checked_tag)]
+    tags = sparse.pivot(index='row_id', columns='label', values='value')
+    # a label that no row has still gets its column
+    return tags.reindex(columns=tags.columns.union(['t_Surname']))
+
+
+def analyze(tagged_fn, report_fn, sparse_fn=None):
+    """Check the errors of a tagged file and write the error rates"""
+    import pandas as pd
+    print('Reading tagged file: %s' % tagged_fn)
+    header = pd.read_csv(tagged_fn, nrows=0).columns
+    if 'row_id' in header and not sparse_fn:
+        raise ValueError('%s was tagged with --sparse, so pass the same --sparse file' % tagged_fn)
+    # read only the columns the checks need
+    use_cols = [col for col in header if col in ('row_id', 'last_name', 'credential', 'suffix', 'tag_type')
+                or is_checked_tag(col)]
+    # Only an empty field is a missing tag, so a name like NA is kept.
+    df = pd.read_csv(tagged_fn, usecols=use_cols, dtype=str,
+                     keep_default_na=False, na_values=[''])
+    print('Read {:,} rows'.format(df.shape[0]))
+    if sparse_fn:
+        df = df.join(read_sparse_tags(sparse_fn), on=df.row_id.astype('int64'))
+    df = check_frame(df)
+    print(df[error_keys].mean().to_string())
+    report = error_report(df)
+    print(report.to_string(index=False))
+    print('Writing error report: %s' % report_fn)
+    report.to_csv(report_fn, index=False)
+
+
+if '__main__' == __name__:
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Tag the CMS Physician data set with probablepeople and check for errors')
+    parser.add_argument('in_fn', nargs='?',
+                        help='input .csv file (default: %s), or the tagged file with --analyze' % in_fn)
+    parser.add_argument('out_fn', nargs='?',
+                        help='output .csv file (default: %s), or the error report with --analyze' % out_fn)
+    parser.add_argument('--analyze', action='store_true',
+                        help='instead of tagging, report error rates by tag type, credential and suffix')
+    tag_csv.add_arguments(parser)
+    args = parser.parse_args()
+    if args.analyze:
+        if not args.out_fn:
+            parser.error('--analyze requires the tagged file and the report file')
+        analyze(args.in_fn, args.out_fn, args.sparse)
+        parser.exit()
+    tag_csv.tag_file(args.in_fn or in_fn, args.out_fn or out_fn, check_row, error_keys,
+                     cache=tag_csv.make_cache(args), workers=args.workers,
+                     batch_size=args.batch_size, sparse_fn=args.sparse)
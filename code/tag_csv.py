@@ -8,73 +8,334 @@
 Run a CSV through probablepeople to tag all rows. It's
 also useful to check for tagging errors.
 
-Tested with Python 2.7
-"""
+The output columns are fixed up front from the labels that
+probablepeople knows, so each row is written as soon as it is
+tagged, and memory use is constant.
+
+Names repeat, so tags are memoized in a bounded LRU cache, which
+may be kept in a file between runs with --cache-file.
+
+Tagging is CPU-bound, so --workers tags batches of names in a
+process pool and writes the rows in input order.
 
-import probablepeople as pp
+Most of the wide t_ columns are empty on any row, so --sparse writes
+the tags to a separate file in long format as (row_id, label, value),
+which may be Parquet with dictionary-encoded labels.
+
+Tested with Python 3
+"""
 
 from collections import OrderedDict
 import csv
-import sys
+import os
+import pickle
+import time
 
-tagged_rows = []
-tags = set()
-initial_keys  = []
+# probablepeople.tag() prefixes a label that repeats after the
+# words "and", "aka", and "for"
+TAG_PREFIXES = ('', 'Second', 'Other', 'Proxied')
 
 
-def read(fn_in):
-    global tags, tagged_rows, initial_keys 
-    print 'Reading and parsing: %s' % fn_in
-    with open(fn_in, 'rb') as incsvfile:
-        reader = csv.DictReader(incsvfile, delimiter=',')
-        counter = 0
+def tag_fieldnames():
+    """Return the output columns for every label probablepeople can return"""
+    import probablepeople as pp
+    # add t_ prefix to distinguish from original columns
+    return ['t_' + prefix + label for prefix in TAG_PREFIXES for label in pp.LABELS] + ['tag_type']
 
-        for row in reader:
-            # stop early for development
-            #if counter > 1000:
-            #    break
-            try:
-                row['name'] = row['name'].decode('utf8')
-                tagged = pp.tag(row['name'])
-                # add t_ prefix to distinguish from original columns
-                tagged0 = OrderedDict(('t_'+k, v) for k, v in tagged[0].viewitems())
-                # add type
-                tagged0['tag_type'] = tagged[1]
-                # add to dictionary of input values
-                row.update(tagged0)
-            except pp.RepeatedLabelError:
-                row['tag_type'] = 'RepeatedLabelError'
-            except UnicodeEncodeError:
-                #https://github.com/datamade/probablepeople/issues/54
-                row['tag_type'] = 'UnicodeEncodeError'
-            [tags.add(t) for t in row.keys()]
-            tagged_rows.append(row)
-            counter = counter + 1
 
-    print 'Read {:,} rows'.format(counter)
+def tag_name(name):
+    """Tag a name, and return RepeatedLabelError as the type instead of raising it"""
+    import probablepeople as pp
+    try:
+        return pp.tag(name)
+    except pp.RepeatedLabelError:
+        return {}, 'RepeatedLabelError'
+
+
+class TagCache:
+    """Bounded LRU cache of tag_name() with hit rate reporting
+
+    Names repeat heavily in these data sets, so this saves parsing the
+    same name again. Optionally, the cache is kept in a file between runs.
+    """
+
+    def __init__(self, maxsize=100000, fn=None):
+        self.maxsize = maxsize
+        self.fn = fn
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+        if fn and os.path.exists(fn):
+            with open(fn, 'rb') as f:
+                self.entries = pickle.load(f)
+            print('Loaded {:,} cached tags from {}'.format(len(self.entries), fn))
+            self.evict()
+
+    def __call__(self, name):
+        if name in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return self.entries[name]
+        start_time = time.perf_counter()
+        result = tag_name(name)
+        self.add(name, result, time.perf_counter() - start_time)
+        return result
+
+    def add(self, name, result, seconds):
+        """Add the result of a miss that took seconds to tag"""
+        self.misses += 1
+        self.miss_seconds += seconds
+        self.entries[name] = result
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries beyond maxsize"""
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """Write the cache to its file, if any"""
+        if not self.fn:
+            return
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fn, self.fn)
+
+    def report(self):
+        """Print the hit rate and the estimated time saved"""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return
+        seconds_per_miss = self.miss_seconds / max(self.misses, 1)
+        print('Tag cache: {:,} hits, {:,} misses, {:.1f}% hit rate, about {:.1f} seconds saved'.format(
+            self.hits, self.misses, 100.0 * self.hits / lookups, self.hits * seconds_per_miss))
+
+
+def tag_row(row, tag=tag_name):
+    """Tag the name in a row and add the tags to the row"""
+    return add_tags(row, tag(row['name']))
+
+
+def add_tags(row, result):
+    """Add the result of tag_name() to the row"""
+    tags, tag_type = result
+    row.update(('t_' + k, v) for k, v in tags.items())
+    # add type
+    row['tag_type'] = tag_type
+    return row
+
+
+def tag_names(names):
+    """Tag a batch of names and return pairs of the result and seconds taken
+
+    The seconds go into the TagCache of the parent, which estimates
+    the time its hits saved from them.
+    """
+    results = []
+    for name in names:
+        start_time = time.perf_counter()
+        result = tag_name(name)
+        results.append((result, time.perf_counter() - start_time))
+    return results
 
-    # preserve the original order of field names
-    initial_keys = reader.fieldnames
 
-def write(fn_out):
-    global tags, tagged_rows, initial_keys 
-    print 'Writing output: %s' % fn_out
+def tag_rows_parallel(rows, workers, cache=None, batch_size=5000):
+    """Tag rows in a process pool and yield them in input order
 
-    tags_unique = [tag for tag in tags if not tag in initial_keys]
-    out_fields = initial_keys + tags_unique
+    Only the distinct names of each batch that are neither in the cache
+    nor already sent with an earlier batch go to the workers, so each
+    name is tagged and counted as a miss once, as in a serial run.
+    """
+    import collections
+    import itertools
+    from multiprocessing import Pool
 
-    with open(fn_out, 'wb') as outcsvfile:
-        writer = csv.DictWriter(outcsvfile, fieldnames=out_fields)
+    # names sent to the workers and not yet added to the cache
+    pending = set()
+
+    def submit(pool, batch):
+        names = {row['name'] for row in batch}
+        if cache:
+            # The earlier batch is taken first, so by then its names
+            # are in the cache.
+            names = [name for name in names
+                     if name not in cache.entries and name not in pending]
+            pending.update(names)
+        names = list(names)
+        return batch, names, pool.apply_async(tag_names, (names,))
+
+    rows_iter = iter(rows)
+    with Pool(processes=workers) as pool:
+        # Keep a bounded window of batches in flight, so memory stays
+        # constant, and take their results in input order.
+        window = collections.deque()
+        while True:
+            while len(window) < 2 * workers:
+                batch = list(itertools.islice(rows_iter, batch_size))
+                if not batch:
+                    break
+                window.append(submit(pool, batch))
+            if not window:
+                return
+            batch, names, async_result = window.popleft()
+            results = async_result.get()
+            fresh = {}
+            for name, (result, seconds) in zip(names, results):
+                fresh[name] = result
+                if cache:
+                    cache.add(name, result, seconds)
+            pending.difference_update(names)
+            for row in batch:
+                name = row['name']
+                if not cache:
+                    result = fresh[name]
+                elif name in fresh:
+                    # the first row with the name was the miss
+                    result = fresh.pop(name)
+                else:
+                    result = cache(name)
+                yield add_tags(row, result)
+
+
+class SparseParquetWriter:
+    """Write (row_id, label, value) triples to Parquet with dictionary-encoded labels
+
+    This has the writerow() and writerows() of a csv.writer, so it can
+    take its place.
+    """
+
+    def __init__(self, fn, rows_per_group=1000000):
+        import pyarrow as pa
+        import pyarrow.parquet
+        self.pa = pa
+        self.schema = pa.schema([('row_id', pa.int64()),
+                                 ('label', pa.dictionary(
+                                     pa.int8(), pa.string())),
+                                 ('value', pa.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(fn, self.schema)
+        self.rows_per_group = rows_per_group
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.rows_per_group:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = self.pa
+        row_ids, labels, values = zip(*self.rows)
+        label_type = self.schema.field('label').type
+        table = pa.table([pa.array(row_ids, pa.int64()),
+                          pa.array(labels).dictionary_encode().cast(label_type),
+                          pa.array(values, pa.string())], schema=self.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def add_arguments(parser):
+    """Add the command line options shared by the tagging scripts"""
+    parser.add_argument('--cache-size', default=100000, type=int,
+                        help='number of distinct names to keep tags for (0 to disable)')
+    parser.add_argument('--cache-file',
+                        help='keep the tag cache in this file between runs')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='number of processes tagging names')
+    parser.add_argument('--batch-size', default=5000, type=int,
+                        help='number of rows sent to the workers at a time')
+    parser.add_argument('--sparse',
+                        help='write the tags to this .csv or .parquet file as (row_id, label, value) instead of wide t_ columns')
+
+
+def make_cache(args):
+    """Return the TagCache for the command line options, or None"""
+    if not args.cache_size:
+        return None
+    return TagCache(args.cache_size, args.cache_file)
+
+
+def tag_file(fn_in, fn_out, check_row=None, extra_fieldnames=(), cache=None,
+             workers=1, batch_size=5000, sparse_fn=None):
+    """Tag each row of a CSV file and write it immediately
+
+    The optional check_row is called on each tagged row before it is
+    written, and it may add the columns in extra_fieldnames.
+
+    With sparse_fn, fn_out gets a row_id column instead of the wide t_
+    columns, and the tags go to sparse_fn as (row_id, label, value).
+    """
+    import contextlib
+    print('Reading, parsing and writing: %s -> %s' % (fn_in, fn_out))
+    with contextlib.ExitStack() as stack:
+        incsvfile = stack.enter_context(
+            open(fn_in, encoding='utf-8', newline=''))
+        outcsvfile = stack.enter_context(
+            open(fn_out, 'w', encoding='utf-8', newline=''))
+        reader = csv.DictReader(incsvfile, delimiter=',')
+        # preserve the original order of field names
+        initial_keys = reader.fieldnames
+        if sparse_fn:
+            print('Writing sparse tags: %s' % sparse_fn)
+            if sparse_fn.endswith('.parquet'):
+                sparse_writer = SparseParquetWriter(sparse_fn)
+                stack.callback(sparse_writer.close)
+            else:
+                sparsecsvfile = stack.enter_context(
+                    open(sparse_fn, 'w', encoding='utf-8', newline=''))
+                sparse_writer = csv.writer(sparsecsvfile)
+                sparse_writer.writerow(['row_id', 'label', 'value'])
+            out_fields = ['row_id'] + initial_keys + \
+                [key for key in ('tag_type',) if key not in initial_keys]
+        else:
+            tags_unique = [
+                tag for tag in tag_fieldnames() if tag not in initial_keys]
+            out_fields = initial_keys + tags_unique
+        out_fields = out_fields + list(extra_fieldnames)
+        # With sparse_fn, the t_ columns are not written here.
+        writer = csv.DictWriter(outcsvfile, fieldnames=out_fields,
+                                extrasaction='ignore' if sparse_fn else 'raise')
         writer.writeheader()
-        for tagged_row in tagged_rows:
-            encoded_row = {k:v.encode('utf8') for k,v in tagged_row.items()}
-            writer.writerow(encoded_row)
+        if workers > 1:
+            tagged_rows = tag_rows_parallel(
+                reader, workers, cache, batch_size)
+        else:
+            tagger = cache or tag_name
+            tagged_rows = (tag_row(row, tagger) for row in reader)
+        counter = 0
+        for row in tagged_rows:
+            if check_row:
+                row = check_row(row)
+            if sparse_fn:
+                row['row_id'] = counter
+                sparse_writer.writerows((counter, key[2:], value) for key, value in row.items()
+                                        if key.startswith('t_') and key not in initial_keys)
+            writer.writerow(row)
+            counter = counter + 1
+
+    print('Tagged {:,} rows'.format(counter))
+    if cache:
+        cache.report()
+        cache.save()
+
 
 if '__main__' == __name__:
-    if not 3 == len(sys.argv):
-        print ('usage: tag_csv.py input_file.csv output_file.csv')
-        sys.exit(1)
-    fn_in = sys.argv[1]
-    fn_out = sys.argv[2]
-    read(fn_in)
-    write(fn_out)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Tag the name column of a CSV file with probablepeople')
+    parser.add_argument('fn_in', help='input .csv file with a name column')
+    parser.add_argument('fn_out', help='output .csv file')
+    add_arguments(parser)
+    args = parser.parse_args()
+    tag_file(args.fn_in, args.fn_out, cache=make_cache(args),
+             workers=args.workers, batch_size=args.batch_size, sparse_fn=args.sparse)
@@ -0,0 +1,45 @@
+#
+# Copyright (C) 2024 by Compassion International.  All rights reserved.
+# License GPLv3+: GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law.
+
+
+"""
+Code shared by wikidata_org.py and wikidata_person_bio.py
+"""
+
+import sqlite3
+import time
+
+# Wikimedia asks clients to identify themselves
+user_agent = 'entity-metadata/1.0 (https://github.com/az0/entity-metadata)'
+
+
+def connect_sqlite(fn):
+    """Open a SQLite file that several processes may share
+
+    WAL journaling lets readers go on during a write, and the busy
+    timeout waits for another writer instead of failing.
+    """
+    conn = sqlite3.connect(fn, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header, either seconds or an HTTP date
+
+    Returns 0 when the header is missing or not understood.
+    """
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
@@ -12,94 +12,379 @@ called "wikidata" with Wikidata IDs, and then for each entity, it looks up
 metadata about the entities in Wikidata. It creates another CSV file with
 this metadata.
 
-This program works with Python 3.6.
+Entities are requested in batches of 50 ids, and then the labels of their
+types and countries in one more batch, so a few requests cover many rows.
+Entities and labels are cached in a SQLite file, so reruns and overlapping
+exports are served locally.
 
-This program is slow. Try the other one! :)
-"""
+Requests run concurrently with asyncio, within limits on concurrency and
+requests per second, and the rows are written in input order. They send
+maxlag, and failed requests are retried with backoff, waiting as long as
+Retry-After asks.
 
-# non-standard imports
-from joblib import Memory
-from wikidata.client import Client
-import percache
+This program works with Python 3.7.
+"""
 
 # standard imports
+import asyncio
+import json
 import os.path
-import sys
-import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
-# set up cache
-tmpdir = os.path.join(tempfile.gettempdir(), 'wikidata.org.percache')
-cache = percache.Cache(tmpdir)
+from wikidata_common import connect_sqlite, retry_after_seconds, user_agent
 
 # globals
 fieldnames = ['wikidata_id', 'name', 'instance_of', 'country']
+api_url = 'https://www.wikidata.org/w/api.php'
+# the most ids wbgetentities accepts per request
+batch_size = 50
+p_instance_of = 'P31'
+p_country = 'P17'
+default_cache_fn = os.path.expanduser('~/.cache/wikidata_org.sqlite3')
+# the API refuses requests while its database replicas lag more than this
+# many seconds, instead of adding to the load
+maxlag_seconds = 5
+# attempts per request, and the first backoff in seconds, doubling
+max_attempts = 5
+backoff_seconds = 2
+# SQLite allows 999 parameters in older versions
+sql_batch_size = 500
+
+
+class EntityCache:
+    """Persistent cache of organizations and labels in a single SQLite file
+
+    Entries older than the TTL are looked up again. WAL journaling and a
+    busy timeout let several processes share the file safely. Missing
+    entities are cached too, so they are not requested again.
+    """
+
+    def __init__(self, fn=default_cache_fn, ttl_days=30):
+        if not fn == ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+        self.ttl_seconds = ttl_days * 86400
+        self.conn = connect_sqlite(fn)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS organization ('
+                              'wikidata_id TEXT PRIMARY KEY, name TEXT, instance_of TEXT, '
+                              'country TEXT, missing INTEGER NOT NULL, fetched REAL NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS label ('
+                              'wikidata_id TEXT PRIMARY KEY, label TEXT, fetched REAL NOT NULL)')
+
+    def select(self, sql, wikidata_ids, params=()):
+        """Run a SELECT with an IN clause over many ids, in batches"""
+        wikidata_ids = list(wikidata_ids)
+        for start in range(0, len(wikidata_ids), sql_batch_size):
+            batch = wikidata_ids[start:start + sql_batch_size]
+            placeholders = ','.join('?' * len(batch))
+            yield from self.conn.execute(sql % placeholders, list(params) + batch)
+
+    def stale_ids(self, table, wikidata_ids):
+        """Return the ids that are not cached or are older than the TTL"""
+        sql = 'SELECT wikidata_id FROM ' + table + \
+            ' WHERE fetched > ? AND wikidata_id IN (%s)'
+        fresh = {row[0] for row in self.select(
+            sql, wikidata_ids, [time.time() - self.ttl_seconds])}
+        return [wikidata_id for wikidata_id in wikidata_ids if wikidata_id not in fresh]
+
+    def get_organizations(self, wikidata_ids):
+        """Return cached organizations, except missing ones, keyed by id"""
+        return {row[0]: dict(zip(fieldnames, row)) for row in self.select(
+            'SELECT wikidata_id, name, instance_of, country FROM organization '
+            'WHERE missing = 0 AND wikidata_id IN (%s)', wikidata_ids)}
+
+    def put_organizations(self, organizations, missing_ids):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO organization VALUES (?, ?, ?, ?, 0, ?)',
+                                  [(o['wikidata_id'], o['name'], o['instance_of'], o['country'], now)
+                                   for o in organizations])
+            self.conn.executemany('INSERT OR REPLACE INTO organization VALUES (?, NULL, NULL, NULL, 1, ?)',
+                                  [(wikidata_id, now) for wikidata_id in missing_ids])
+
+    def get_labels(self, wikidata_ids):
+        return dict(self.select('SELECT wikidata_id, label FROM label WHERE wikidata_id IN (%s)', wikidata_ids))
+
+    def put_labels(self, labels):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO label VALUES (?, ?, ?)',
+                                  [(wikidata_id, label, now) for wikidata_id, label in labels.items()])
+
+
+class RateLimiter:
+    """Limit the requests in flight and the requests per second
+
+    Use it as an async context manager around each request.
+    """
+
+    def __init__(self, concurrency=4, requests_per_second=5.0):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.lock = asyncio.Lock()
+        self.next_time = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        # space out the start of each request
+        async with self.lock:
+            now = asyncio.get_event_loop().time()
+            if self.next_time > now:
+                await asyncio.sleep(self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+
+    def pause(self, seconds):
+        """Start no request for the given seconds, as asked by Retry-After"""
+        now = asyncio.get_event_loop().time()
+        self.next_time = max(self.next_time, now + seconds)
+
+
+class RetryableError(Exception):
+    """A failed request worth trying again, after retry_after seconds if not 0"""
 
-# set up Wikidata client
-client = Client()
-p_instance_of = client.get('P31')
-p_country = client.get('P17')
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
-def get_label(e, p):
-    """Get label from Wikidata"""
-    r = None
+def fetch_entities(batch, props, url=api_url):
+    """Get one batch of up to 50 entities from the Wikidata API
+
+    This blocks, so it runs in a thread.
+    """
+    print('get %d entities from %s to %s' % (len(batch), batch[0], batch[-1]))
+    params = {'action': 'wbgetentities', 'ids': '|'.join(batch),
+              'props': props, 'languages': 'en', 'format': 'json',
+              'maxlag': maxlag_seconds}
+    request = urllib.request.Request(url + '?' + urllib.parse.urlencode(params),
+                                     headers={'User-Agent': user_agent})
     try:
-        r = e[p].label
-    except KeyError:
-        pass
-    return r
+        with urllib.request.urlopen(request) as response:
+            retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+            result = json.load(response)
+    except urllib.error.HTTPError as e:
+        raise RetryableError('HTTP status %d' % e.code,
+                             retry_after_seconds(e.headers.get('Retry-After')))
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        raise RetryableError(str(e))
+    if 'error' in result:
+        if result['error'].get('code') == 'maxlag':
+            raise RetryableError('database lag', retry_after or maxlag_seconds)
+        raise RuntimeError('Wikidata API error: %s' % result['error'])
+    entities = {}
+    for key, entity in result.get('entities', {}).items():
+        entities[key] = entity
+        # a redirected id returns the entity it redirects to
+        redirect_from = entity.get('redirects', {}).get('from')
+        if redirect_from:
+            entities[redirect_from] = entity
+    return entities
+
+
+async def get_entities(wikidata_ids, props, url, limiter):
+    """Get entities from the Wikidata API in concurrent batches of up to 50 ids"""
+    loop = asyncio.get_event_loop()
+    # dedupe while keeping the order
+    wikidata_ids = list(dict.fromkeys(wikidata_ids))
+
+    async def fetch(batch):
+        for attempt in range(1, max_attempts + 1):
+            try:
+                async with limiter:
+                    return await loop.run_in_executor(None, fetch_entities, batch, props, url)
+            except RetryableError as e:
+                if attempt == max_attempts:
+                    raise
+                if e.retry_after:
+                    # every request waits, not just this one
+                    limiter.pause(e.retry_after)
+                    delay = e.retry_after
+                else:
+                    delay = backoff_seconds * 2 ** (attempt - 1)
+                print('retry %d entities from %s in %s seconds: %s' %
+                      (len(batch), batch[0], delay, e))
+                await asyncio.sleep(delay)
+    batches = [wikidata_ids[start:start + batch_size]
+               for start in range(0, len(wikidata_ids), batch_size)]
+    entities = {}
+    for batch_entities in await asyncio.gather(*[fetch(batch) for batch in batches]):
+        entities.update(batch_entities)
+    return entities
+
+
+def get_label(entity):
+    """Get the English label of an entity"""
+    return entity.get('labels', {}).get('en', {}).get('value')
+
+
+def get_claim_id(entity, p):
+    """Get the id of the first entity that is a value of property p"""
+    for claim in entity.get('claims', {}).get(p, []):
+        try:
+            return claim['mainsnak']['datavalue']['value']['id']
+        except (KeyError, TypeError):
+            continue
+    return None
+
+
+async def lookup_organizations(wikidata_ids, cache, url, limiter):
+    """Look up entities, presumed to be organizations, on Wikidata
+
+    Only entities not fresh in the cache are requested, in concurrent
+    batches. Each batch then requests the labels of its instance of
+    (P31) and country (P17) values that are not cached, and goes into
+    the cache as soon as it completes. A batch that fails after its
+    retries is left out.
 
+    Returns a dictionary of labels keyed by Wikidata id. Missing
+    entities are omitted.
+    """
+    # dedupe while keeping the order
+    wikidata_ids = list(dict.fromkeys(wikidata_ids))
+    fetch_ids = cache.stale_ids('organization', wikidata_ids)
+    batches = [fetch_ids[start:start + batch_size]
+               for start in range(0, len(fetch_ids), batch_size)]
+    results = await asyncio.gather(*[lookup_batch(batch, cache, url, limiter)
+                                     for batch in batches], return_exceptions=True)
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            # skip only this batch; the next run requests it again
+            print('skipping %d entities from %s: %r' % (len(batch), batch[0], result))
+    return cache.get_organizations(wikidata_ids)
 
-@cache
-def lookup_organization(wikidata_id):
+
+async def lookup_batch(batch, cache, url, limiter):
+    """Look up one batch of organizations, and cache them with their labels"""
+    entities = await get_entities(batch, 'labels|claims', url, limiter)
+    value_ids = set()
+    for entity in entities.values():
+        for p in (p_instance_of, p_country):
+            value_ids.add(get_claim_id(entity, p))
+    value_ids.discard(None)
+    stale_value_ids = cache.stale_ids('label', sorted(value_ids))
+    if stale_value_ids:
+        cache.put_labels({key: get_label(entity) for key, entity in
+                          (await get_entities(stale_value_ids, 'labels', url, limiter)).items()})
+    value_labels = cache.get_labels(value_ids)
+
+    organizations = []
+    missing_ids = []
+    for wikidata_id in batch:
+        entity = entities.get(wikidata_id)
+        if not entity or 'missing' in entity:
+            print('missing %s' % wikidata_id)
+            missing_ids.append(wikidata_id)
+            continue
+        # labels for entity
+        labels = dict()
+        labels['wikidata_id'] = wikidata_id
+        labels['name'] = get_label(entity)
+        labels['instance_of'] = value_labels.get(
+            get_claim_id(entity, p_instance_of))
+        labels['country'] = value_labels.get(
+            get_claim_id(entity, p_country))
+        organizations.append(labels)
+    cache.put_organizations(organizations, missing_ids)
+
+
+def lookup_organization(wikidata_id, cache, url=api_url):
     """Look up an entity, presumed to be an organization, on Wikidata"""
-    print ('lookup organization %s' % wikidata_id)
-    # get entity
-    entity = client.get(wikidata_id)
+    print('lookup organization %s' % wikidata_id)
+
+    async def lookup():
+        return await lookup_organizations([wikidata_id], cache, url, RateLimiter())
+    return asyncio.run(lookup()).get(wikidata_id)
+
+
+def read_ids(fn_in):
+    """Read the Wikidata ids from a PetScan CSV file"""
+    import csv
+    import re
+    with open(fn_in, encoding='utf-8') as csvfile_in:
+        reader = csv.reader(csvfile_in)
+        header_row = next(reader)
+        wikidata_index = header_row.index('wikidata')
+        for row in reader:
+            wikidata_id = row[wikidata_index]
+            if not wikidata_id or not re.match(r'Q\d+', wikidata_id):
+                # Some entries from PetScan have no ID
+                continue
+            yield wikidata_id
+
+
+async def resolve(fn_in, writer, flush, cache, url, chunk_size, concurrency, requests_per_second):
+    """Look up chunks of ids concurrently, and write them in input order"""
+    import collections
+    import itertools
+    import traceback
+    limiter = RateLimiter(concurrency, requests_per_second)
+    wikidata_ids = read_ids(fn_in)
+    # chunks being looked up, oldest first
+    pending = collections.deque()
 
-    # labels for entity
-    labels = dict()
-    labels['wikidata_id'] = wikidata_id
-    labels['name'] = entity.label
-    labels['instance_of'] = get_label(entity, p_instance_of)
-    labels['country'] = get_label(entity, p_country)
+    async def write_oldest():
+        chunk, task = pending.popleft()
+        try:
+            results = await task
+        except Exception:
+            traceback.print_exc()
+            return
+        # one row per input row, in input order
+        writer.writerows(results[wikidata_id]
+                         for wikidata_id in chunk if wikidata_id in results)
+        # one flush per chunk instead of per row
+        flush()
 
-    return labels
+    while True:
+        chunk = list(itertools.islice(wikidata_ids, chunk_size))
+        if not chunk:
+            break
+        pending.append((chunk, asyncio.ensure_future(
+            lookup_organizations(chunk, cache, url, limiter))))
+        if len(pending) >= concurrency:
+            await write_oldest()
+    while pending:
+        await write_oldest()
 
 
-def main(fn_in, fn_out):
+def main(fn_in, fn_out, url=api_url, chunk_size=500, cache_fn=default_cache_fn, ttl_days=30,
+         concurrency=4, requests_per_second=5.0):
     import csv
+    cache = EntityCache(cache_fn, ttl_days)
     # The newline='' avoids blank lines between rows.
     with open(fn_out, 'w', encoding='utf-8', newline='') as csvfile_out:
         writer = csv.DictWriter(csvfile_out, fieldnames=fieldnames)
         writer.writeheader()
-        with open(fn_in, encoding='utf-8') as csvfile_in:
-            reader = csv.reader(csvfile_in)
-            header_row = next(reader)
-            wikidata_index = header_row.index('wikidata')
-            for row in reader:
-                wikidata_id = row[wikidata_index]
-                import re
-                if not wikidata_id or not re.match('Q\d+', wikidata_id):
-                    # Some entries from PetScan have no ID
-                    continue
-                print ('read id %s' % wikidata_id)
-                try:
-                    labels = lookup_organization(wikidata_id)
-                except KeyboardInterrupt:
-                    break
-                except:
-                    import traceback
-                    traceback.print_exc()
-                    continue
-                writer.writerow(labels)
-                csvfile_out.flush()
+        try:
+            asyncio.run(resolve(fn_in, writer, csvfile_out.flush, cache, url,
+                                chunk_size, concurrency, requests_per_second))
+        except KeyboardInterrupt:
+            pass
 
 
 if '__main__' == __name__:
-    if not 3 == len(sys.argv):
-        print ('usage: wikidata_org.py input_file.csv output_file.csv')
-        sys.exit(1)
-    fn_in = sys.argv[1]
-    fn_out = sys.argv[2]
-    main(fn_in, fn_out)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Look up metadata of organizations in a PetScan CSV file on Wikidata')
+    parser.add_argument('fn_in', help='PetScan .csv file with a wikidata column')
+    parser.add_argument('fn_out', help='output .csv file')
+    parser.add_argument('--api-url', default=api_url,
+                        help='Wikidata API endpoint, such as a local stand-in for testing (default: %(default)s)')
+    parser.add_argument('--cache-file', default=default_cache_fn,
+                        help='SQLite file that caches entities between runs (default: %(default)s)')
+    parser.add_argument('--ttl-days', default=30, type=float,
+                        help='look up cached entities again after this many days (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', default=4, type=int,
+                        help='most requests in flight at once (default: %(default)s)')
+    parser.add_argument('-r', '--requests-per-second', default=5.0, type=float,
+                        help='most requests started per second (default: %(default)s)')
+    args = parser.parse_args()
+    main(args.fn_in, args.fn_out, args.api_url,
+         cache_fn=args.cache_file, ttl_days=args.ttl_days,
+         concurrency=args.concurrency, requests_per_second=args.requests_per_second)
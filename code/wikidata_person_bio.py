@@ -10,29 +10,230 @@
 This program downloads basic biographical data about people using
 SPARL queries to Wikidata.
 
-The output files are untransformed CSV files. Each date of birth
-is a separate file, so combine them with a script.
+The output files are untransformed CSV files. Each file covers a range
+of dates of birth, named by its first and last dates (or just the date
+when the range is a single day), so combine them with
+combine_wikidata_person.py.
 
-Tip: run a few in parallel, each with a separate time period. To be
-nice to the servers, do not run too many processes at once.
+With --storage packs, the results are instead compressed into a few
+append-only pack files with an index (see PackStore), which saves
+space and inodes on a long harvest. list_results() and open_result()
+read both kinds of storage.
+
+Ranges are adaptive. Sparse periods are fetched many days per query,
+and a range is split in half when its query times out or reaches the
+row limit, so each query stays within the time limit of the service.
+Days already saved in the data directory are skipped.
+
+Queries from all processes share one budget through a rate file: at
+most 5 queries in flight and 60 seconds of query time per 60 seconds,
+the limits of the service. The budget pauses when the service asks
+for it with Retry-After, so run a few in parallel, each with a
+separate time period, without sleeping between queries.
+
+The state of each range is kept in a ledger in the data directory.
+Failed ranges are retried with exponential backoff, and interrupted
+or failed ranges are queued again by the next run. Use --status to
+see the progress of a harvest.
 """
 
 import datetime
+import json
 import os
+import re
 import sys
 import time
 
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, so there only one process may use the files.
+    fcntl = None
+
+from wikidata_common import connect_sqlite, retry_after_seconds, user_agent
+
 url = 'https://query.wikidata.org/sparql'
+# bytes read from the response at a time
+block_size = 65536
+# the HTTP session of this process, made by get_session()
+session = None
 
+hdr_row = 'person,personLabel,family_nameLabel,given_nameLabel,sex_or_genderLabel,dob,country_of_citizenshipLabel,ethnic_groupLabel'
 
-def get_dob(dob, data_dir, timeout_seconds, success_sleep, error_sleep):
-    """Download a CSV file from Wikidata for a single date of birth"""
-    dob_str = dob.isoformat()
-    csv_fn = os.path.join(data_dir, dob_str+".csv")
-    print(f'Querying the date of birth: {dob}')
-    if os.path.exists(csv_fn):
-        print(f' {dob}: Skipping because its file already exists.')
-        return
+range_fn_re = re.compile(r'^(\d{4}-\d\d-\d\d)(?:_(\d{4}-\d\d-\d\d))?\.csv$')
+
+one_day = datetime.timedelta(days=1)
+
+# the job ledger, in the data directory
+ledger_fn = 'ledger.sqlite3'
+
+# the pack files of compressed results, their index and their lock
+pack_fn_format = 'pack-{:04d}.gz'
+pack_index_fn = 'packs.idx'
+pack_lock_fn = 'packs.lock'
+# start a new pack file after this size
+pack_max_bytes = 2**30
+# the pack stores of this process, made by get_pack_store()
+pack_stores = {}
+
+
+def range_fn(start, end):
+    """Return the file name for the dates of birth from start to end, inclusive"""
+    if start == end:
+        return start.isoformat() + '.csv'
+    return f'{start.isoformat()}_{end.isoformat()}.csv'
+
+
+def read_pack_index(data_dir, position=0):
+    """Read the pack index from a byte position
+
+    Returns the entries as (name, pack_fn, offset, length, sha1) tuples
+    and the position after the last complete line.
+    """
+    index_fn = os.path.join(data_dir, pack_index_fn)
+    if not os.path.exists(index_fn):
+        return [], position
+    with open(index_fn, 'rb') as f:
+        f.seek(position)
+        data = f.read()
+    # a line still being written has no newline yet
+    data = data[:data.rfind(b'\n') + 1]
+    entries = []
+    for line in data.decode('utf-8').splitlines():
+        name, pack_fn, offset, length, sha1 = line.split(',')
+        entries.append((name, pack_fn, int(offset), int(length), sha1))
+    return entries, position + len(data)
+
+
+def saved_results(data_dir):
+    """Return the saved results in the data directory, keyed by file name
+
+    A result is either the path of a CSV file or a (pack path, offset,
+    length) tuple. A later result for a range replaces an earlier one.
+    """
+    results = {fn: os.path.join(data_dir, fn)
+               for fn in os.listdir(data_dir) if range_fn_re.match(fn)}
+    for name, pack_fn, offset, length, _sha1 in read_pack_index(data_dir)[0]:
+        results[name] = (os.path.join(data_dir, pack_fn), offset, length)
+    return results
+
+
+def list_results(data_dir):
+    """Return the saved results to read with open_result(), each once, in order"""
+    return sorted(set(saved_results(data_dir).values()), key=str)
+
+
+def open_result(result):
+    """Open a saved result as a text file, decompressing a packed one as it is read"""
+    if isinstance(result, str):
+        return open(result, newline='', encoding='utf-8')
+    import gzip
+    import io
+    pack_path, offset, length = result
+    with open(pack_path, 'rb') as f:
+        f.seek(offset)
+        member = f.read(length)
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(member)),
+                            newline='', encoding='utf-8')
+
+
+class PackStore:
+    """Compressed results in a few append-only pack files
+
+    Each result is a gzip member appended to the newest pack, so zcat
+    of a pack prints its CSV files one after another. The index has a
+    line for each result with its name, pack, offset, length and the
+    SHA-1 of its content. Results with the same content, such as the
+    many with just a header, are stored once. A lock file serializes
+    the appends, so several processes can share the packs.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.index_position = 0
+        self.by_sha1 = {}
+
+    def compress(self, in_fn, out_fn):
+        """Compress a file to a gzip member, and return the SHA-1 of its content"""
+        import gzip
+        import hashlib
+        sha1 = hashlib.sha1()
+        with open(in_fn, 'rb') as f_in, open(out_fn, 'wb') as f_out:
+            # no name or time, so the same content compresses the same
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f_out, mtime=0) as f_gz:
+                for block in iter(lambda: f_in.read(block_size), b''):
+                    sha1.update(block)
+                    f_gz.write(block)
+        return sha1.hexdigest()
+
+    def newest_pack(self):
+        """Return the name of the pack to append to"""
+        number = 0
+        while os.path.exists(os.path.join(self.data_dir, pack_fn_format.format(number + 1))):
+            number += 1
+        pack_fn = pack_fn_format.format(number)
+        pack_path = os.path.join(self.data_dir, pack_fn)
+        if os.path.exists(pack_path) and os.path.getsize(pack_path) >= pack_max_bytes:
+            pack_fn = pack_fn_format.format(number + 1)
+        return pack_fn
+
+    def add(self, name, in_fn):
+        """Store the content of a file as the result with the given name"""
+        import shutil
+        gz_fn = in_fn + '.gz'
+        sha1 = self.compress(in_fn, gz_fn)
+        try:
+            with open(os.path.join(self.data_dir, pack_lock_fn), 'a') as lock:
+                lock_file(lock)
+                # learn what other processes stored since the last time
+                entries, self.index_position = read_pack_index(
+                    self.data_dir, self.index_position)
+                for _name, pack_fn, offset, length, entry_sha1 in entries:
+                    self.by_sha1[entry_sha1] = (pack_fn, offset, length)
+                if sha1 not in self.by_sha1:
+                    pack_fn = self.newest_pack()
+                    with open(os.path.join(self.data_dir, pack_fn), 'ab') as f_pack, \
+                            open(gz_fn, 'rb') as f_gz:
+                        offset = f_pack.tell()
+                        shutil.copyfileobj(f_gz, f_pack)
+                        length = f_pack.tell() - offset
+                    self.by_sha1[sha1] = (pack_fn, offset, length)
+                pack_fn, offset, length = self.by_sha1[sha1]
+                # the index line goes last, so a crash leaves no dangling entry
+                with open(os.path.join(self.data_dir, pack_index_fn), 'a') as f_index:
+                    f_index.write(f'{name},{pack_fn},{offset},{length},{sha1}\n')
+        finally:
+            discard(gz_fn)
+
+
+def lock_file(f):
+    """Lock an open file for this process until it is closed"""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+
+def get_pack_store(data_dir):
+    """Return the pack store of this process for the data directory"""
+    if data_dir not in pack_stores:
+        pack_stores[data_dir] = PackStore(data_dir)
+    return pack_stores[data_dir]
+
+
+def covered_days(data_dir):
+    """Return the set of dates of birth already saved in the data directory"""
+    days = set()
+    for fn in saved_results(data_dir):
+        match = range_fn_re.match(fn)
+        start = datetime.date.fromisoformat(match.group(1))
+        end = datetime.date.fromisoformat(match.group(2) or match.group(1))
+        while start <= end:
+            days.add(start)
+            start += one_day
+    return days
+
+
+def make_query(start, end, limit=None):
+    """Return the SPARQL query for the dates of birth from start to end, inclusive"""
     query = """
 SELECT  ?person
         ?personLabel
@@ -55,58 +256,472 @@ WHERE {
 	  optional { ?person wdt:P21 ?sex_or_gender. }
 	  optional { ?person wdt:P27 ?country_of_citizenship. }
 	  optional { ?person wdt:P172 ?ethnic_group. }
-      filter("%s"^^xsd:dateTime = ?dob)
+      filter("%s"^^xsd:dateTime <= ?dob && ?dob < "%s"^^xsd:dateTime)
     }
   }
   # Putting the label service outside of the query optimizes the performance.
   SERVICE wikibase:label { bd:serviceParam wikibase:language "en". }
 }
-    """ % dob_str
-    headers = {'Accept': 'text/csv'}
-    import http
+    """ % (start.isoformat(), (end + one_day).isoformat())
+    if limit:
+        query += 'LIMIT %d\n' % limit
+    return query
+
+
+def count_rows(fn):
+    """Count the CSV records after the header, allowing newlines in labels"""
+    import csv
+    with open(fn, newline='', encoding='utf-8') as f:
+        return sum(1 for _row in csv.reader(f)) - 1
+
+
+def get_session():
+    """Return the HTTP session of this process, making it on first use
+
+    Each worker process keeps its own pool of connections, so queries
+    reuse a TLS connection instead of opening a new one each time.
+    """
+    global session
+    if session is None:
+        import requests
+        session = requests.Session()
+        session.headers.update({'Accept': 'text/csv',
+                                'Accept-Encoding': 'gzip, deflate',
+                                'User-Agent': user_agent})
+    return session
+
+
+def stream_body(result_r, fn):
+    """Write the decompressed response body to a file a block at a time
+
+    Returns the size and the first and last blocks, which is where
+    the service puts error messages.
+    """
+    size = 0
+    head = tail = b''
+    with open(fn, 'wb') as f:
+        for block in result_r.iter_content(chunk_size=block_size):
+            f.write(block)
+            size += len(block)
+            if len(head) < block_size:
+                head += block[:block_size - len(head)]
+            tail = (tail + block)[-block_size:]
+    return size, (head + tail).decode('utf-8', errors='replace')
+
+
+def discard(fn):
+    """Remove a partial file, if there is one"""
+    if os.path.exists(fn):
+        os.remove(fn)
+
+
+class QueryBudget:
+    """Share the query limits of Wikidata among processes
+
+    "One client (user agent + IP) is allowed 60 seconds of processing
+    time each 60 seconds" and 5 parallel queries.
+    https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits
+
+    The processing time is a token bucket kept in a JSON file, locked
+    for each update, so every process using the same file draws from
+    the same budget. A query reserves the average latency of recent
+    queries and is charged its actual latency when it finishes.
+
+    Without file locking, the state stays in the memory of this process.
+    """
+
+    def __init__(self, fn, max_concurrent=5, budget_seconds=60.0, period_seconds=60.0):
+        self.fn = fn
+        self.max_concurrent = max_concurrent
+        self.budget_seconds = budget_seconds
+        self.rate = budget_seconds / period_seconds
+        self.state = None
+
+    def load_state(self, text, now):
+        """Parse the saved state, starting afresh when it is empty or damaged"""
+        fresh = {'tokens': self.budget_seconds, 'time': now, 'latency': 1.0,
+                 'paused_until': 0.0, 'in_flight': {}}
+        try:
+            state = json.loads(text)
+            if set(state) == set(fresh) and isinstance(state['in_flight'], dict):
+                return state
+        except (ValueError, TypeError):
+            pass
+        if text:
+            print(f'Starting the query budget afresh, because {self.fn} is damaged')
+        return fresh
+
+    def update(self, func):
+        """Call func(state, now) with the shared state locked, and save it"""
+        if fcntl is None:
+            now = time.time()
+            if self.state is None:
+                self.state = self.load_state('', now)
+            return self.apply(func, self.state, now)
+        with open(self.fn, 'a+') as f:
+            lock_file(f)
+            f.seek(0)
+            now = time.time()
+            state = self.load_state(f.read(), now)
+            result = self.apply(func, state, now)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            return result
+
+    def apply(self, func, state, now):
+        """Refill the budget for the time passed, and call func(state, now)"""
+        state['tokens'] = min(self.budget_seconds,
+                              state['tokens'] + (now - state['time']) * self.rate)
+        state['time'] = now
+        return func(state, now)
+
+    def try_acquire(self, state, now):
+        """Reserve a query, returning the seconds to wait and the ticket"""
+        in_flight = state['in_flight']
+        # forget the queries of processes that died; only POSIX can
+        # check, and elsewhere the state is not shared anyway
+        for pid in list(in_flight) if fcntl is not None else ():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                del in_flight[pid]
+            except PermissionError:
+                pass
+        cost = min(state['latency'], self.budget_seconds)
+        if now < state['paused_until']:
+            return state['paused_until'] - now, None
+        if sum(in_flight.values()) >= self.max_concurrent:
+            return 0.5, None
+        if state['tokens'] < cost:
+            return (cost - state['tokens']) / self.rate, None
+        state['tokens'] -= cost
+        pid = str(os.getpid())
+        in_flight[pid] = in_flight.get(pid, 0) + 1
+        return 0, (now, cost)
+
+    def acquire(self):
+        """Wait for the budget to allow a query, and return its ticket"""
+        while True:
+            wait_seconds, ticket = self.update(self.try_acquire)
+            if ticket:
+                return ticket
+            time.sleep(min(wait_seconds, 5))
+
+    def release(self, ticket, pause_seconds=0):
+        """Charge the latency of a finished query, and pause all queries if asked"""
+        started, reserved = ticket
+
+        def func(state, now):
+            latency = now - started
+            state['tokens'] -= latency - reserved
+            state['latency'] = 0.8 * state['latency'] + 0.2 * latency
+            state['paused_until'] = max(state['paused_until'], now + pause_seconds)
+            pid = str(os.getpid())
+            # the state may have started afresh since the query began
+            if state['in_flight'].get(pid, 0) > 1:
+                state['in_flight'][pid] -= 1
+            else:
+                state['in_flight'].pop(pid, None)
+        self.update(func)
+
+    def pause(self, seconds):
+        """Stop all queries for a while"""
+        def func(state, now):
+            state['paused_until'] = max(state['paused_until'], now + seconds)
+        self.update(func)
+
+
+def get_dob(start, end, data_dir, timeout_seconds, success_sleep, error_sleep, max_rows,
+            limiter, storage='files'):
+    """Download a CSV file from Wikidata for a range of dates of birth
+
+    Returns a tuple of the range, the outcome and the number of rows.
+    The outcome is 'saved', 'error' (which the ledger retries later),
+    'retry' when the service limited the rate, or 'split' when the range
+    spans several days and is too big for one query.
+    """
+    dob = start.isoformat() if start == end else f'{start} to {end}'
+    csv_fn = os.path.join(data_dir, range_fn(start, end))
+    # the body goes to a partial file, renamed only once it is valid
+    part_fn = f'{csv_fn}.{os.getpid()}.part'
+    print(f'Querying the date of birth: {dob}')
+    can_split = start < end
+    # One more row than the limit tells whether the result was cut short.
+    query = make_query(start, end, max_rows + 1 if can_split else None)
     import requests
+    ticket = limiter.acquire()
+    size = None
+    pause_seconds = 0
     try:
-        result_r = requests.get(
-            url, params={'query': query}, headers=headers, timeout=timeout_seconds)
-    except http.client.RemoteDisconnected:
-        print(f' {dob}: Remote end closed connection without response')
-        time.sleep(error_sleep)
-        return
-    except requests.exceptions.ReadTimeout:
-        print(f' {dob}: network read timeout')
-        time.sleep(error_sleep)
-        return
+        with get_session().get(url, params={'query': query}, timeout=timeout_seconds,
+                               stream=True) as result_r:
+            status_code = result_r.status_code
+            retry_after = retry_after_seconds(result_r.headers.get('Retry-After'))
+            size, ends = stream_body(result_r, part_fn)
+        pause_seconds = retry_after
+    except requests.exceptions.RequestException as e:
+        # a timeout while reading the body comes wrapped in a ConnectionError
+        if isinstance(e, requests.exceptions.ReadTimeout) or 'Read timed out' in str(e):
+            print(f' {dob}: network read timeout')
+            if can_split:
+                return start, end, 'split', 0
+            return start, end, 'error', 0
+        # for example a ConnectionError, or a ChunkedEncodingError when
+        # the connection drops in the middle of the body
+        print(f' {dob}: request error: {e!r}')
+        pause_seconds = error_sleep
+        return start, end, 'error', 0
+    finally:
+        limiter.release(ticket, pause_seconds)
+        if size is None:
+            discard(part_fn)
+
+    if status_code == 429:
+        discard(part_fn)
+        print(f' {dob}: too many requests, so pausing {retry_after:.0f} seconds')
+        if not retry_after:
+            limiter.pause(error_sleep)
+        return start, end, 'retry', 0
 
     is_error = False
 
-    if not result_r.status_code == 200:
-        print(f' {dob}: HTTP status code {result_r.status_code}')
+    # The query service answers 500 with a Java exception when a query
+    # exceeds its 60-second limit.
+    if 'java.util.concurrent.TimeoutException' in ends:
+        print(f' {dob}: query timeout')
+        if can_split:
+            discard(part_fn)
+            return start, end, 'split', 0
+        is_error = True
+
+    if not status_code == 200:
+        print(f' {dob}: HTTP status code {status_code}')
         is_error = True
 
     server_error_msg = 'Our servers are currently under maintenance or experiencing a technical problem'
-    if server_error_msg in result_r.text:
+    if server_error_msg in ends:
         print(f' {dob}: {server_error_msg}')
         is_error = True
 
-    if len(result_r.text) == 0:
+    if size == 0:
         print(f' {dob}: The server returned an empty file, so not saving it.')
         is_error = True
 
     if is_error:
-        # "One client (user agent + IP) is allowed 60 seconds of processing time each 60 seconds"
-        # https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits
-        time.sleep(error_sleep)
-        return
+        discard(part_fn)
+        # give the servers a rest, unless they already said how long
+        if not retry_after:
+            limiter.pause(error_sleep)
+        return start, end, 'error', 0
 
-    hdr_row = 'person,personLabel,family_nameLabel,given_nameLabel,sex_or_genderLabel,dob,country_of_citizenshipLabel,ethnic_groupLabel'
-    if result_r.text.strip('\n').strip('\r') == hdr_row:
+    rows = count_rows(part_fn)
+    if can_split and rows > max_rows:
+        discard(part_fn)
+        print(f' {dob}: more than {max_rows} rows, so splitting the range')
+        time.sleep(success_sleep)
+        return start, end, 'split', rows
+
+    if rows == 0:
         print(
             f' {dob}: The server returned just a header, so there were zero results.')
 
-    with open(csv_fn, 'wb') as f:
-        f.write(result_r.text.encode('utf-8'))
+    if storage == 'packs':
+        get_pack_store(data_dir).add(range_fn(start, end), part_fn)
+        discard(part_fn)
+    else:
+        os.replace(part_fn, csv_fn)
 
     time.sleep(success_sleep)
+    return start, end, 'saved', rows
+
+
+class JobLedger:
+    """Persistent state of each range of dates of birth in a single SQLite file
+
+    A range is queued, running, done, split (into two queued halves) or
+    failed. An error requeues a range with exponential backoff until it
+    has used max_attempts. Each run requeues the failed and interrupted
+    ranges of earlier runs, so repeated runs converge to full coverage.
+    """
+
+    def __init__(self, fn, max_attempts=8, backoff_seconds=60, max_backoff_seconds=3600):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.conn = connect_sqlite(fn)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS job ('
+                              'start TEXT NOT NULL, end TEXT NOT NULL, state TEXT NOT NULL, '
+                              'attempts INTEGER NOT NULL, next_try REAL NOT NULL, rows INTEGER, '
+                              'updated REAL NOT NULL, PRIMARY KEY (start, end))')
+
+    def select(self, sql, first, last, params=()):
+        """Run a statement over the ranges from first to last
+
+        The %s in sql must come before the placeholders of params.
+        """
+        return self.conn.execute(sql % 'start >= ? AND end <= ?',
+                                 [first.isoformat(), last.isoformat()] + list(params))
+
+    def set_state(self, start, end, state, attempts=0, next_try=0.0, rows=None):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (start.isoformat(), end.isoformat(), state, attempts, next_try,
+                               rows, time.time()))
+
+    def requeue(self, first, last):
+        """Queue the failed and interrupted ranges again, and return their days"""
+        with self.conn:
+            self.select("UPDATE job SET attempts = CASE state WHEN 'failed' THEN 0 ELSE attempts END, "
+                        "state = 'queued', next_try = 0 "
+                        "WHERE state IN ('failed', 'running') AND %s", first, last)
+        return {day for start, end in self.select("SELECT start, end FROM job WHERE state = 'queued' "
+                                                  "AND %s", first, last)
+                for day in days_between(datetime.date.fromisoformat(start),
+                                        datetime.date.fromisoformat(end))}
+
+    def next_job(self, first, last):
+        """Take the next queued range whose backoff is over, or return None"""
+        row = self.select("SELECT start, end, attempts FROM job WHERE state = 'queued' "
+                          "AND %s AND next_try <= ? ORDER BY next_try, start LIMIT 1",
+                          first, last, [time.time()]).fetchone()
+        if row is None:
+            return None
+        start, end = datetime.date.fromisoformat(row[0]), datetime.date.fromisoformat(row[1])
+        self.set_state(start, end, 'running', row[2])
+        return start, end
+
+    def wait_seconds(self, first, last):
+        """Return the seconds until a queued range is due, or None when none is queued"""
+        next_try = self.select("SELECT MIN(next_try) FROM job WHERE state = 'queued' AND %s",
+                               first, last).fetchone()[0]
+        return None if next_try is None else max(0, next_try - time.time())
+
+    def fail(self, start, end):
+        """Count a failed attempt, and queue the range again unless attempts ran out"""
+        attempts = self.conn.execute('SELECT attempts FROM job WHERE start = ? AND end = ?',
+                                     (start.isoformat(), end.isoformat())).fetchone()[0] + 1
+        if attempts >= self.max_attempts:
+            self.set_state(start, end, 'failed', attempts)
+            return
+        backoff = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempts - 1))
+        self.set_state(start, end, 'queued', attempts, time.time() + backoff)
+
+    def summary(self, first, last):
+        """Return the number of ranges and days in each state"""
+        counts = {}
+        for start, end, state in self.select('SELECT start, end, state FROM job WHERE %s',
+                                             first, last):
+            days = (datetime.date.fromisoformat(end) - datetime.date.fromisoformat(start)).days + 1
+            ranges_n, days_n = counts.get(state, (0, 0))
+            counts[state] = (ranges_n + 1, days_n + days)
+        return counts
+
+    def failed(self, first, last):
+        return self.select("SELECT start, end, attempts FROM job WHERE state = 'failed' AND %s "
+                           "ORDER BY start", first, last).fetchall()
+
+
+def days_between(start, end):
+    """Return the list of days from start to end, inclusive"""
+    return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+class RangeScheduler:
+    """Choose the ranges of dates of birth to query
+
+    Queued ranges in the ledger come first: split halves, rate-limited
+    ranges, and failed ranges whose backoff is over. Otherwise a new
+    range starts at the first day not yet covered by a file or by a
+    queued range.
+
+    New ranges start at max_days wide and adapt to the results: the
+    width halves when a range is split, and otherwise follows the rows
+    per day of the last range, aiming for half of max_rows and at most
+    doubling.
+    """
+
+    def __init__(self, first, last, covered, ledger, max_days, max_rows):
+        self.first = first
+        self.last = last
+        self.next_day = first
+        self.ledger = ledger
+        self.covered = covered | ledger.requeue(first, last)
+        self.max_days = max_days
+        self.max_rows = max_rows
+        self.width = max_days
+        self.queries = 0
+        self.total_days = (last - first).days + 1
+        self.done_days = len([day for day in covered if first <= day <= last])
+        self.days_this_run = 0
+        self.start_time = time.time()
+
+    def next_range(self):
+        """Return the next (start, end) range to query, or None when none is due"""
+        job = self.ledger.next_job(self.first, self.last)
+        if job:
+            return job
+        while self.next_day <= self.last and self.next_day in self.covered:
+            self.next_day += one_day
+        if self.next_day > self.last:
+            return None
+        start = end = self.next_day
+        while (end - start).days + 1 < self.width and end < self.last \
+                and end + one_day not in self.covered:
+            end += one_day
+        self.next_day = end + one_day
+        self.ledger.set_state(start, end, 'running')
+        return start, end
+
+    def wait_seconds(self):
+        """Return the seconds until a queued range is due, or None when all are finished"""
+        return self.ledger.wait_seconds(self.first, self.last)
+
+    def report(self, start, end, outcome, rows):
+        """Record the outcome of a query, and adapt to it"""
+        self.queries += 1
+        days = (end - start).days + 1
+        if outcome == 'split':
+            self.width = max(1, min(self.width, days) // 2)
+            middle = start + datetime.timedelta(days=days // 2 - 1)
+            self.ledger.set_state(start, end, 'split')
+            self.ledger.set_state(start, middle, 'queued')
+            self.ledger.set_state(middle + one_day, end, 'queued')
+        elif outcome == 'retry':
+            self.ledger.set_state(start, end, 'queued')
+        elif outcome == 'error':
+            self.ledger.fail(start, end)
+        else:
+            self.ledger.set_state(start, end, 'done', rows=rows)
+            self.done_days += days
+            self.days_this_run += days
+            # aim for half of max_rows, growing at most twofold at a time
+            target = days * (self.max_rows // 2) // max(rows, 1)
+            self.width = max(1, min(self.max_days, days * 2, target))
+        if self.queries % 10 == 0:
+            print(self.progress())
+
+    def progress(self):
+        """Return a line with the days done and the estimated time remaining"""
+        line = f'Progress: {self.done_days} of {self.total_days} days ' \
+            f'({100 * self.done_days / self.total_days:.1f}%) after {self.queries} queries'
+        elapsed = time.time() - self.start_time
+        if self.days_this_run:
+            eta = (self.total_days - self.done_days) * elapsed / self.days_this_run
+            line += ', ETA %s' % datetime.timedelta(seconds=round(eta))
+        return line
+
+
+def print_status(ledger, first, last, covered):
+    """Print the coverage of the data directory and the state of the ledger"""
+    total_days = (last - first).days + 1
+    covered_n = len([day for day in covered if first <= day <= last])
+    print(f'{covered_n} of {total_days} days ({100 * covered_n / total_days:.1f}%) are saved')
+    for state, (ranges_n, days_n) in sorted(ledger.summary(first, last).items()):
+        print(f' {state}: {ranges_n} ranges, {days_n} days')
+    for start, end, attempts in ledger.failed(first, last):
+        print(f' failed after {attempts} attempts: {start} to {end}')
 
 
 def go():
@@ -123,40 +738,102 @@ def go():
     parser.add_argument(
         '-p', '--parallel', help='number of parallel processes', default=1, type=int)
     parser.add_argument('-e', '--error-sleep',
-                        help='number of seconds to sleep after an error', default=60, type=float)
+                        help='number of seconds to pause all queries after an error, '
+                        'and the first backoff before retrying the range', default=60, type=float)
     parser.add_argument('-s', '--success-sleep',
-                        help='number of seconds to sleep after a success', default=0.5, type=float)
+                        help='number of seconds to sleep after a success', default=0, type=float)
     parser.add_argument(
         '-t', '--timeout', help='number of seconds to wait for a response', default=120, type=int)
+    parser.add_argument('--max-days', help='largest number of days in one query',
+                        default=366, type=int)
+    parser.add_argument('--max-rows', help='split a range returning more rows than this',
+                        default=10000, type=int)
+    parser.add_argument('--rate-file', help='file sharing the query budget among processes',
+                        default=os.path.expanduser('~/.cache/wikidata_person_bio.rate'))
+    parser.add_argument('--max-concurrent', help='most queries in flight among all processes',
+                        default=5, type=int)
+    parser.add_argument('--max-attempts', help='attempts per range before it fails until the next run',
+                        default=8, type=int)
+    parser.add_argument('--max-backoff', help='most seconds to wait before retrying a range',
+                        default=3600, type=float)
+    parser.add_argument('--status', help='print the progress of the ledger and exit',
+                        action='store_true')
+    parser.add_argument('--storage', choices=('files', 'packs'), default='files',
+                        help='save each result as a CSV file, or compressed in a few pack files')
     args = parser.parse_args()
 
     if not os.path.exists(args.data_dir):
         print(f'Making data directory: {args.data_dir}')
         os.mkdir(args.data_dir)
-    if args.parallel > 5:
-        print('Warning: Wikidata has a limit of 5 parallel queries. See https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits')
-    dates = []
-    d = datetime.date(args.beginning_year, 1, 1)
-    while d <= datetime.date(args.ending_year, 12, 31):
-        dates.append(d)
-        d += datetime.timedelta(days=1)
+    first = datetime.date(args.beginning_year, 1, 1)
+    last = datetime.date(args.ending_year, 12, 31)
+    ledger = JobLedger(os.path.join(args.data_dir, ledger_fn),
+                       args.max_attempts, args.error_sleep, args.max_backoff)
+    covered = covered_days(args.data_dir)
+    if args.status:
+        print_status(ledger, first, last, covered)
+        return
+    if args.parallel > 1 and fcntl is None:
+        parser.error('--parallel needs file locking, which this platform lacks')
+    if args.parallel > args.max_concurrent:
+        print(f'Warning: only {args.max_concurrent} queries run at once. See https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits')
+    os.makedirs(os.path.dirname(os.path.abspath(args.rate_file)), exist_ok=True)
+    scheduler = RangeScheduler(first, last, covered, ledger, args.max_days, args.max_rows)
     kwargs = {'data_dir': args.data_dir,
               'timeout_seconds': args.timeout,
               'success_sleep':  args.success_sleep,
-              'error_sleep':  args.error_sleep}
+              'error_sleep':  args.error_sleep,
+              'max_rows': args.max_rows,
+              'limiter': QueryBudget(args.rate_file, args.max_concurrent),
+              'storage': args.storage}
 
     if args.parallel > 1:
-        # process in parallel
+        # process in parallel, keeping one query in flight per process
         from multiprocessing import Pool
-        from functools import partial
-        pool = Pool(processes=args.parallel)
-        func = partial(get_dob, **kwargs)
-        for i in pool.imap_unordered(func, dates):
-            pass
+        import queue
+        done = queue.Queue()
+        in_flight = 0
+        with Pool(processes=args.parallel) as pool:
+            while True:
+                while in_flight < args.parallel:
+                    next_range = scheduler.next_range()
+                    if next_range is None:
+                        break
+                    pool.apply_async(get_dob, next_range, kwargs,
+                                     callback=done.put, error_callback=done.put)
+                    in_flight += 1
+                if not in_flight:
+                    wait_seconds = scheduler.wait_seconds()
+                    if wait_seconds is None:
+                        break
+                    print(f'Waiting {wait_seconds:.0f} seconds to retry a range')
+                    time.sleep(wait_seconds)
+                    continue
+                # wake up when a backoff ends, to fill the idle workers
+                timeout = scheduler.wait_seconds() if in_flight < args.parallel else None
+                try:
+                    result = done.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                in_flight -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                scheduler.report(*result)
     else:
         # process one at a time
-        for date in dates:
-            get_dob(date, **kwargs)
+        while True:
+            next_range = scheduler.next_range()
+            if next_range is None:
+                wait_seconds = scheduler.wait_seconds()
+                if wait_seconds is None:
+                    break
+                print(f'Waiting {wait_seconds:.0f} seconds to retry a range')
+                time.sleep(wait_seconds)
+                continue
+            scheduler.report(*get_dob(*next_range, **kwargs))
+
+    print(scheduler.progress())
+    print_status(ledger, first, last, covered_days(args.data_dir))
 
 
 if __name__ == '__main__':